@@ -2,21 +2,38 @@
 # -*- coding: utf-8 -*-
 
 from base64 import b32encode
+import binascii
+from contextlib import contextmanager
+import errno
+import fcntl
+import logging
+import multiprocessing
 import os
 import subprocess
+import tempfile
+import threading
+import time
 
 from Crypto.Random import random
 import gnupg
 from gnupg._util import _is_stream, _make_binary_stream
+import pgpy
 import scrypt
 
 import config
+import rm
+import secure_tempfile
 import store
 
 # to fix gpg error #78 on production
 os.environ['USERNAME'] = 'www-data'
 
+log = logging.getLogger(__name__)
+
 GPG_KEY_TYPE = "RSA"
+# The name in the UID of reply keypairs, whose email is the source's
+# filesystem id (python-gnupg's default)
+GPG_KEY_NAME = "Autogenerated Key"
 if os.environ.get('SECUREDROP_ENV') == 'test':
     # Optimize crypto to speed up tests (at the expense of security - DO NOT
     # use these settings in production)
@@ -37,11 +54,6 @@ DEFAULT_WORDS_IN_RANDOM_ID = 8
 def do_runtime_tests():
     if config.SCRYPT_ID_PEPPER == config.SCRYPT_GPG_PEPPER:
         raise AssertionError('SCRYPT_ID_PEPPER == SCRYPT_GPG_PEPPER')
-    # crash if we don't have srm:
-    try:
-        subprocess.check_call(['srm'], stdout=subprocess.PIPE)
-    except subprocess.CalledProcessError:
-        pass
 
 
 do_runtime_tests()
@@ -54,10 +66,145 @@ nouns = open(config.NOUNS).read().rstrip('\n').split('\n')
 adjectives = open(config.ADJECTIVES).read().rstrip('\n').split('\n')
 
 
+# Index of the reply keypairs in the keyring, mapping a source's
+# filesystem_id (the email part of the key's UID) to the key's fingerprint.
+# Listing the keyring forks gpg2 and parses every key, which gets slow as
+# the number of sources grows, so the index is loaded once and kept up to
+# date by `genkeypair` and `delete_reply_keypair`. It is reloaded whenever
+# the keyring files are modified by another process.
+_keyring_index = {}
+_keyring_signature = None
+_keyring_lock = threading.Lock()
+
+# gpg2 >= 2.1 uses a keybox, earlier versions use the legacy keyring format
+KEYRING_FILES = ('pubring.kbx', 'pubring.gpg')
+
+# Reply keypairs can be generated ahead of time by `fill_keypool`, so that
+# flagged sources get one without waiting for a 4096-bit key generation.
+# The UID of a pooled keypair is KEYPOOL_PREFIX followed by a random id. Its
+# passphrase is derived from a random secret, kept in KEYPOOL_SECRETS_DIR
+# under the same name until `take_pooled_keypair` assigns the keypair and
+# securely deletes the secret. The pool is refilled once it holds no more
+# than KEYPOOL_LOW_WATER keypairs.
+KEYPOOL_PREFIX = 'keypool-'
+KEYPOOL_SIZE = getattr(config, 'KEYPOOL_SIZE', 0)
+KEYPOOL_LOW_WATER = getattr(config, 'KEYPOOL_LOW_WATER', KEYPOOL_SIZE // 2)
+KEYPOOL_SECRETS_DIR = 'keypool'
+KEYPOOL_LOCK_FILE = 'keypool.lock'
+KEYPOOL_FILL_LOCK_FILE = 'keypool-fill.lock'
+
+# gpg reads 300 bytes from /dev/random to generate a key (issue #303)
+MIN_KEYGEN_ENTROPY = 2400
+
+
 class CryptoException(Exception):
     pass
 
 
+class ScryptBusyException(Exception):
+    """Raised when too many scrypt hashes are already running or waiting
+    to run. The web applications answer it with a 503."""
+    pass
+
+
+class ScryptPool(object):
+    """Bound the number of scrypt hashes computed at once.
+
+    scrypt is called through ctypes, which releases the GIL, so hashes
+    computed by request threads already run in parallel; what needs to be
+    limited is how many of them compete for the CPUs. At most *workers*
+    hashes run at a time, and at most *max_queued* requests wait (for up
+    to *timeout* seconds) for one of them to finish. Beyond that,
+    :exc:`ScryptBusyException` is raised right away, instead of letting
+    requests pile up behind a burst of logins.
+
+    Background hashes, such as those filling the codename pool, only take
+    a free slot no request is waiting for. They wait for as long as it
+    takes, and aren't counted against *max_queued*.
+
+    The time spent waiting and hashing is recorded, see :meth:`stats`.
+    """
+
+    def __init__(self, workers, max_queued, timeout):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.running = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self._stats = dict(hashes=0, rejected=0, wait_time=0.0,
+                           max_wait_time=0.0, hash_time=0.0,
+                           max_hash_time=0.0)
+
+    def _acquire(self, background=False):
+        start = time.time()
+        with self.condition:
+            if background:
+                while self.running >= self.workers or self.waiting:
+                    self.condition.wait()
+                self.running += 1
+                return time.time() - start
+            if (self.running >= self.workers and
+                    self.waiting >= self.max_queued):
+                self._stats['rejected'] += 1
+                raise ScryptBusyException("scrypt pool is saturated")
+            self.waiting += 1
+            try:
+                while self.running >= self.workers:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        self._stats['rejected'] += 1
+                        raise ScryptBusyException(
+                            "timed out waiting for the scrypt pool")
+                    self.condition.wait(remaining)
+                self.running += 1
+            finally:
+                self.waiting -= 1
+        return time.time() - start
+
+    def _release(self, wait_time, hash_time, background=False):
+        with self.condition:
+            self.running -= 1
+            # Wake up background hashes too, so they can yield to requests
+            self.condition.notify_all()
+            self._stats['hashes'] += 1
+            self._stats['hash_time'] += hash_time
+            if not background:
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(
+                    self._stats['max_wait_time'], wait_time)
+            self._stats['max_hash_time'] = max(self._stats['max_hash_time'],
+                                               hash_time)
+
+    def hash(self, password, salt, background=False, **params):
+        """Return ``scrypt.hash(password, salt, **params)``, once the pool
+        has room for it."""
+        wait_time = self._acquire(background)
+        start = time.time()
+        try:
+            return scrypt.hash(password, salt, **params)
+        finally:
+            hash_time = time.time() - start
+            self._release(wait_time, hash_time, background)
+            log.debug("scrypt hash: waited {:.3f}s, hashed in {:.3f}s".format(
+                wait_time, hash_time))
+
+    def stats(self):
+        """Return the number of hashes computed and rejected so far, the
+        total and maximum time spent waiting for the pool and hashing, and
+        the number of hashes currently running and waiting."""
+        with self.condition:
+            stats = dict(self._stats, running=self.running,
+                         waiting=self.waiting)
+        return stats
+
+
+scrypt_pool = ScryptPool(
+    workers=getattr(config, 'SCRYPT_WORKERS', multiprocessing.cpu_count()),
+    max_queued=getattr(config, 'SCRYPT_MAX_QUEUED', 16),
+    timeout=getattr(config, 'SCRYPT_QUEUE_TIMEOUT', 5))
+
+
 def clean(s, also=''):
     """
     >>> clean("[]")
@@ -117,14 +264,19 @@ def display_id():
     return ' '.join([random.choice(adjectives), random.choice(nouns)])
 
 
-def hash_codename(codename, salt=SCRYPT_ID_PEPPER):
+def hash_codename(codename, salt=SCRYPT_ID_PEPPER, background=False):
     """Salts and hashes a codename using scrypt.
 
     :param str codename: A source's codename.
     :param str salt: The salt to mix with the codename when hashing.
+    :param bool background: Whether the hash is computed ahead of time
+                            rather than for a request, and should yield to
+                            requests (see :class:`ScryptPool`).
     :returns: A base32 encoded string; the salted codename hash.
     """
-    return b32encode(scrypt.hash(clean(codename), salt, **SCRYPT_PARAMS))
+    return b32encode(scrypt_pool.hash(clean(codename), salt,
+                                      background=background,
+                                      **SCRYPT_PARAMS))
 
 
 def genkeypair(name, secret):
@@ -149,11 +301,16 @@ def genkeypair(name, secret):
     """
     name = clean(name)
     secret = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
-    return gpg.gen_key(gpg.gen_key_input(
+    signature = _get_keyring_signature()
+    genkey_obj = gpg.gen_key(gpg.gen_key_input(
         key_type=GPG_KEY_TYPE, key_length=GPG_KEY_LENGTH,
         passphrase=secret,
+        name_real=GPG_KEY_NAME,
         name_email=name
     ))
+    if genkey_obj.fingerprint:
+        _update_keyring_index(signature, {name: genkey_obj.fingerprint})
+    return genkey_obj
 
 
 def delete_reply_keypair(source_filesystem_id):
@@ -164,17 +321,447 @@ def delete_reply_keypair(source_filesystem_id):
         return
     # The private key needs to be deleted before the public key can be deleted
     # http://pythonhosted.org/python-gnupg/#deleting-keys
+    signature = _get_keyring_signature()
     gpg.delete_keys(key, True)  # private key
     gpg.delete_keys(key)  # public key
+    _update_keyring_index(signature, {source_filesystem_id: None})
     # TODO: srm?
 
 
-def getkey(name):
+def _get_keyring_signature():
+    """Return the (name, mtime, size) of each keyring file present in
+    `config.GPG_KEY_DIR`, which changes whenever a key is added to or
+    removed from the keyring.
+    """
+    signature = []
+    for keyring in KEYRING_FILES:
+        try:
+            st = os.stat(os.path.join(config.GPG_KEY_DIR, keyring))
+        except OSError:
+            continue
+        signature.append((keyring, st.st_mtime, st.st_size))
+    return tuple(signature)
+
+
+def _uid_email(uid):
+    """Return the email part of a UID such as
+    ``Autogenerated Key <FILESYSTEM_ID>``, or the whole UID if it has none.
+    """
+    start = uid.rfind('<')
+    end = uid.rfind('>')
+    if start != -1 and end > start:
+        return uid[start + 1:end]
+    return uid
+
+
+def _load_keyring_index():
+    """Rebuild the keyring index from a full listing of the keyring.
+    Must be called with `_keyring_lock` held.
+    """
+    global _keyring_index, _keyring_signature
+    # Take the signature before listing, so a key added while we are
+    # listing causes another reload instead of being missed.
+    signature = _get_keyring_signature()
+    index = {}
     for key in gpg.list_keys():
         for uid in key['uids']:
-            if name in uid:
-                return key['fingerprint']
-    return None
+            index.setdefault(_uid_email(uid), key['fingerprint'])
+    _keyring_index = index
+    _keyring_signature = signature
+
+
+def _update_keyring_index(signature, changes):
+    """Record in the keyring index that the key for each name in the
+    *changes* dict now has the given fingerprint, or that it was removed
+    if the fingerprint is None.
+
+    :param signature: The keyring signature taken before this process
+                      changed the keyring.
+    """
+    global _keyring_signature
+    with _keyring_lock:
+        if _keyring_signature is None:
+            # Not loaded yet, the first lookup will pick up the change.
+            return
+        if signature != _keyring_signature:
+            # The keyring was also changed by someone else, e.g. the
+            # worker, so the index has to be reloaded on the next lookup.
+            _keyring_signature = None
+            return
+        for name, fingerprint in changes.items():
+            if fingerprint:
+                _keyring_index[name] = fingerprint
+            else:
+                _keyring_index.pop(name, None)
+        # We know about the change we just made to the keyring, so there is
+        # no need to reload the index because of it.
+        _keyring_signature = _get_keyring_signature()
+
+
+def _refresh_keyring_index():
+    """Reload the keyring index if the keyring changed since it was loaded.
+    Must be called with `_keyring_lock` held.
+    """
+    if (_keyring_signature is None or
+            _keyring_signature != _get_keyring_signature()):
+        _load_keyring_index()
+
+
+def getkey(name):
+    """Return the fingerprint of the reply key for the source whose
+    filesystem id is *name*, or None if they don't have one yet.
+    """
+    with _keyring_lock:
+        _refresh_keyring_index()
+        return _keyring_index.get(name)
+
+
+def get_entropy_estimate():
+    return int(open('/proc/sys/kernel/random/entropy_avail').read())
+
+
+def pooled_keypairs():
+    """Return the UIDs of the keypairs in the pool."""
+    with _keyring_lock:
+        _refresh_keyring_index()
+        return sorted(name for name in _keyring_index
+                      if name.startswith(KEYPOOL_PREFIX))
+
+
+def fill_keypool(size=None):
+    """Generate keypairs until the pool holds *size* of them (by default
+    ``KEYPOOL_SIZE``), or the entropy pool runs low, and return how many
+    were generated. This is meant to be run by the worker. Concurrent
+    fills are serialized, so they don't overfill the pool.
+    """
+    if size is None:
+        size = KEYPOOL_SIZE
+    generated = 0
+    with _keypool_lock(KEYPOOL_FILL_LOCK_FILE):
+        while len(pooled_keypairs()) < size:
+            entropy_avail = get_entropy_estimate()
+            if entropy_avail < MIN_KEYGEN_ENTROPY:
+                log.warning("stopped filling the keypool, entropy: {}".format(
+                    entropy_avail))
+                break
+            name = KEYPOOL_PREFIX + binascii.hexlify(os.urandom(16))
+            secret = binascii.hexlify(os.urandom(32))
+            # The secret is stored first, so there is never a pooled keypair
+            # whose passphrase is lost
+            _write_keypool_secret(name, secret)
+            try:
+                genkeypair(name, secret)
+            except Exception:
+                _delete_keypool_secret(name)
+                raise
+            generated += 1
+    return generated
+
+
+def _keypool_secret_path(name):
+    return os.path.join(config.GPG_KEY_DIR, KEYPOOL_SECRETS_DIR, name)
+
+
+def _write_keypool_secret(name, secret):
+    try:
+        os.mkdir(os.path.dirname(_keypool_secret_path(name)), 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd = os.open(_keypool_secret_path(name),
+                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secret)
+
+
+def _read_keypool_secret(name):
+    try:
+        with open(_keypool_secret_path(name)) as f:
+            return f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _delete_keypool_secret(name):
+    try:
+        rm.srm(_keypool_secret_path(name))
+    except rm.SecureDeletionError as e:
+        log.error("Could not delete the secret of pooled keypair {}: "
+                  "{}".format(name, e))
+
+
+@contextmanager
+def _keypool_lock(lock_file=KEYPOOL_LOCK_FILE):
+    """Serialize changes to the pool across processes: taking keypairs from
+    it with the default *lock_file*, and filling it with
+    ``KEYPOOL_FILL_LOCK_FILE``, so that a long fill doesn't hold up taking
+    keypairs."""
+    with open(os.path.join(config.GPG_KEY_DIR, lock_file),
+              'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def take_pooled_keypair(name, secret):
+    """Assign a keypair from the pool to a source, and return its
+    fingerprint, or None if the pool is empty.
+
+    The keypair's passphrase is changed to the one derived from the
+    source's codename, and its UID is replaced with the one
+    :func:`genkeypair` would give it. Its creation date, from when the
+    pool was filled, may still be earlier than the source's. The secret
+    its pooled passphrase was derived from is securely deleted. A keypair
+    that can't be assigned is deleted.
+
+    :param str name: The source's filesystem id.
+    :param str secret: The source's codename.
+    """
+    name = clean(name)
+    passphrase = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
+    with _keypool_lock():
+        pooled = pooled_keypairs()
+        if not pooled:
+            return None
+        pooled_name = pooled[0]
+        fingerprint = getkey(pooled_name)
+        signature = _get_keyring_signature()
+        pooled_secret = _read_keypool_secret(pooled_name)
+        try:
+            if pooled_secret is None:
+                raise CryptoException("its secret is missing")
+            _edit_key(fingerprint, ['passwd', 'save'],
+                      [hash_codename(pooled_secret, salt=SCRYPT_GPG_PEPPER),
+                       passphrase])
+            _edit_key(fingerprint, ['adduid', 'uid 1', 'deluid', 'save'],
+                      [passphrase], uid=name)
+        except CryptoException as e:
+            log.error("Could not take keypair {} from the pool: {}".format(
+                fingerprint, e))
+            gpg.delete_keys(fingerprint, True)  # private key
+            gpg.delete_keys(fingerprint)  # public key
+            _update_keyring_index(signature, {pooled_name: None})
+            return None
+        finally:
+            if pooled_secret is not None:
+                _delete_keypool_secret(pooled_name)
+        _update_keyring_index(signature, {pooled_name: None,
+                                          name: fingerprint})
+    return fingerprint
+
+
+def _gpg_version():
+    try:
+        return tuple(int(n) for n in gpg.binary_version.split('.')[:2])
+    except ValueError:
+        return (0, 0)
+
+
+def _edit_key(fingerprint, commands, passphrases, uid=None):
+    """Run the ``gpg2 --edit-key`` *commands* on *fingerprint*, answering
+    its prompts.
+
+    The first passphrase gpg2 asks for is ``passphrases[0]``, and any later
+    one is the last of *passphrases*, so changing the passphrase takes
+    ``[old, new]``. *uid* is the email of the user id added by ``adduid``,
+    whose name is :data:`GPG_KEY_NAME`.
+
+    :raises: A :exc:`CryptoException` if gpg2 asks an unexpected question
+             or fails.
+    """
+    args = [gpg.binary, '--homedir', config.GPG_KEY_DIR, '--no-tty',
+            '--batch', '--command-fd', '0', '--status-fd', '1',
+            '--allow-freeform-uid']
+    if _gpg_version() >= (2, 1):
+        args.extend(['--pinentry-mode', 'loopback'])
+    args.extend(['--edit-key', fingerprint])
+    answers = {'keygen.name': GPG_KEY_NAME, 'keygen.email': uid,
+               'keygen.comment': '', 'keygen.userid.cmd': 'O',
+               'keyedit.remove.uid.okay': 'y', 'keyedit.save.okay': 'y'}
+    commands = list(commands)
+    passphrases = list(passphrases)
+
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=devnull)
+    for line in iter(proc.stdout.readline, ''):
+        status = line.split()
+        if len(status) < 3 or not status[1].startswith('GET_'):
+            continue
+        keyword = status[2]
+        if status[1] == 'GET_HIDDEN':
+            answer = (passphrases.pop(0) if len(passphrases) > 1
+                      else passphrases[0])
+        elif keyword == 'keyedit.prompt':
+            answer = commands.pop(0) if commands else 'quit'
+        elif answers.get(keyword) is not None:
+            answer = answers[keyword]
+        else:
+            proc.kill()
+            proc.wait()
+            raise CryptoException("unexpected gpg2 prompt: {}".format(
+                keyword))
+        proc.stdin.write(answer + '\n')
+        proc.stdin.flush()
+    if proc.wait() != 0:
+        raise CryptoException("gpg2 --edit-key exited with {}".format(
+            proc.returncode))
+
+
+class GPGBackend(object):
+    """Encrypt and decrypt in a gpg2 subprocess, through python-gnupg.
+
+    Backends only handle encryption and decryption, which happen on every
+    submission, reply and /lookup. Generating, listing and deleting keys
+    always goes through :data:`gpg`.
+    """
+
+    name = 'gpg'
+
+    def __init__(self, gpg):
+        self.gpg = gpg
+
+    def encrypt(self, plaintext, fingerprints, output=None):
+        if not _is_stream(plaintext):
+            plaintext = _make_binary_stream(plaintext, "utf_8")
+
+        out = self.gpg.encrypt(plaintext,
+                               *fingerprints,
+                               output=output,
+                               always_trust=True,
+                               armor=False)
+        if out.ok:
+            return out.data
+        else:
+            raise CryptoException(out.stderr)
+
+    def encrypting_file(self, fingerprints, output):
+        return EncryptingFile(self.gpg, fingerprints, output)
+
+    def decrypt(self, passphrase, ciphertext, fingerprint=None):
+        return self.gpg.decrypt(ciphertext, passphrase=passphrase).data
+
+    def decrypt_many(self, passphrase, ciphertexts, fingerprint=None):
+        # gpg2 can only decrypt several messages at once to files, so this
+        # still takes a subprocess per message.
+        return [self.decrypt(passphrase, ciphertext, fingerprint)
+                for ciphertext in ciphertexts]
+
+
+class PGPyBackend(GPGBackend):
+    """Encrypt and decrypt in-process with PGPy, which saves forking gpg2
+    and loading the keyring for every operation.
+
+    Keys are exported from the keyring the first time they're needed, and
+    kept in memory until the keyring changes. Secret keys stay protected
+    by their passphrase, and are only unlocked for each decryption.
+    Streams (file submissions) are still encrypted by gpg2, so they never
+    have to be read into memory, and so are ciphertexts whose key isn't
+    known.
+    """
+
+    name = 'pgpy'
+
+    def __init__(self, gpg):
+        super(PGPyBackend, self).__init__(gpg)
+        self.keys = {}
+        self.keyring_signature = None
+        self.lock = threading.Lock()
+
+    def _export(self, fingerprint, secret, passphrase=None):
+        args = [self.gpg.binary, '--homedir', config.GPG_KEY_DIR, '--no-tty',
+                '--batch']
+        if secret:
+            if _gpg_version() >= (2, 1):
+                args.extend(['--pinentry-mode', 'loopback'])
+            args.extend(['--passphrase-fd', '0', '--export-secret-keys'])
+        else:
+            args.append('--export')
+        proc = subprocess.Popen(args + [fingerprint], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        data, err = proc.communicate(passphrase or '')
+        if proc.returncode != 0 or not data:
+            raise CryptoException(err)
+        key, _ = pgpy.PGPKey.from_blob(bytearray(data))
+        return key
+
+    def _key(self, fingerprint, secret=False, passphrase=None):
+        with self.lock:
+            signature = _get_keyring_signature()
+            if signature != self.keyring_signature:
+                self.keys.clear()
+                self.keyring_signature = signature
+            if (fingerprint, secret) not in self.keys:
+                self.keys[(fingerprint, secret)] = self._export(
+                    fingerprint, secret, passphrase)
+            return self.keys[(fingerprint, secret)]
+
+    def encrypt(self, plaintext, fingerprints, output=None):
+        if _is_stream(plaintext):
+            return super(PGPyBackend, self).encrypt(plaintext, fingerprints,
+                                                    output)
+        if not fingerprints:
+            # PGPy would happily return the message unencrypted
+            raise CryptoException("no recipients to encrypt to")
+        if isinstance(plaintext, unicode):
+            plaintext = plaintext.encode('utf-8')
+
+        try:
+            message = pgpy.PGPMessage.new(plaintext)
+            cipher = pgpy.constants.SymmetricKeyAlgorithm.AES256
+            session_key = cipher.gen_key()
+            for fingerprint in fingerprints:
+                message = self._key(fingerprint).encrypt(
+                    message, cipher=cipher, sessionkey=session_key)
+            ciphertext = bytes(message)
+        except pgpy.errors.PGPError as e:
+            raise CryptoException(str(e))
+
+        if output:
+            with open(output, 'wb') as fh:
+                fh.write(ciphertext)
+        return ciphertext
+
+    def decrypt(self, passphrase, ciphertext, fingerprint=None):
+        if fingerprint is None:
+            return super(PGPyBackend, self).decrypt(passphrase, ciphertext)
+        return self.decrypt_many(passphrase, [ciphertext], fingerprint)[0]
+
+    def decrypt_many(self, passphrase, ciphertexts, fingerprint=None):
+        if fingerprint is None:
+            return super(PGPyBackend, self).decrypt_many(passphrase,
+                                                         ciphertexts)
+        plaintexts = [''] * len(ciphertexts)
+        try:
+            key = self._key(fingerprint, secret=True, passphrase=passphrase)
+            # Unlocking the key is most of the cost of a decryption, so it is
+            # only done once for all the messages.
+            with key.unlock(passphrase):
+                for i, ciphertext in enumerate(ciphertexts):
+                    try:
+                        message = pgpy.PGPMessage.from_blob(
+                            bytearray(ciphertext))
+                        plaintexts[i] = bytes(key.decrypt(message).message)
+                    except (ValueError, pgpy.errors.PGPError,
+                            pgpy.errors.PGPDecryptionError) as e:
+                        log.debug("Could not decrypt message {} with {}: "
+                                  "{}".format(i, fingerprint, e))
+        except (CryptoException, pgpy.errors.PGPError,
+                pgpy.errors.PGPDecryptionError) as e:
+            # e.g. the wrong passphrase, which gpg2 doesn't raise for either
+            log.debug("Could not unlock {}: {}".format(fingerprint, e))
+        return plaintexts
+
+
+BACKENDS = dict((backend.name, backend)
+                for backend in (GPGBackend, PGPyBackend))
+
+backend = BACKENDS[getattr(config, 'CRYPTO_BACKEND', 'gpg')](gpg)
 
 
 def encrypt(plaintext, fingerprints, output=None):
@@ -189,30 +776,158 @@ def encrypt(plaintext, fingerprints, output=None):
     # using fingerprints to specify recipients.
     fingerprints = [fpr.replace(' ', '') for fpr in fingerprints]
 
-    if not _is_stream(plaintext):
-        plaintext = _make_binary_stream(plaintext, "utf_8")
+    return backend.encrypt(plaintext, fingerprints, output)
+
+
+def encrypting_file(fingerprints, output):
+    """Return a write-only file whose contents are encrypted to
+    *fingerprints* as they are written, into *output*. See
+    :class:`EncryptingFile`.
+    """
+    store.verify(output)
+
+    if not isinstance(fingerprints, (list, tuple)):
+        fingerprints = [fingerprints, ]
+    fingerprints = [fpr.replace(' ', '') for fpr in fingerprints]
+
+    return backend.encrypting_file(fingerprints, output)
+
 
-    out = gpg.encrypt(plaintext,
-                      *fingerprints,
-                      output=output,
-                      always_trust=True,
-                      armor=False)
-    if out.ok:
-        return out.data
-    else:
-        raise CryptoException(out.stderr)
+class EncryptingFile(object):
+    """A write-only file whose contents are encrypted by the gpg2 of *gpg*
+    to *fingerprints* as they are written, into *output*.
 
+    The plaintext is only ever piped to gpg2, so this can encrypt a stream
+    (e.g. a file being uploaded) as it comes in, without buffering it
+    anywhere first. Writes block while gpg2 catches up, which bounds the
+    memory used. :meth:`close` waits for gpg2 to finish, and raises a
+    :exc:`CryptoException` if it failed; :meth:`discard` stops it and
+    removes *output*.
 
-def decrypt(secret, ciphertext):
+    Use :func:`encrypting_file` rather than creating one directly, so the
+    configured backend is used.
+    """
+
+    def __init__(self, gpg, fingerprints, output):
+        self.output = output
+        self.closed = False
+
+        # The same options python-gnupg uses in encrypt()
+        args = [gpg.binary, '--homedir', config.GPG_KEY_DIR, '--no-options',
+                '--no-emit-version', '--no-tty', '--batch', '--always-trust',
+                '--cipher-algo', 'AES256', '--compress-algo', 'ZLIB',
+                '--yes', '--output', output]
+        for fingerprint in fingerprints:
+            args.extend(['--recipient', fingerprint])
+        args.append('--encrypt')
+        # gpg2's diagnostics, which are read if it fails. They may not fill
+        # up a pipe nobody reads while the plaintext is being written.
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self.proc = subprocess.Popen(
+                    args, stdin=subprocess.PIPE, stdout=devnull,
+                    stderr=self.stderr, bufsize=secure_tempfile.CHUNK_SIZE)
+        except OSError:
+            self.stderr.close()
+            raise
+
+    def _error(self):
+        self.stderr.seek(0)
+        return self.stderr.read()
+
+    def write(self, data):
+        if isinstance(data, unicode):  # noqa
+            data = data.encode('utf-8')
+        try:
+            self.proc.stdin.write(data)
+        except IOError:
+            # gpg2 exited early, e.g. because a key is missing
+            self.discard(error=True)
+
+    def flush(self):
+        self.proc.stdin.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                self._remove_output()
+                raise CryptoException(self._error())
+        finally:
+            self.stderr.close()
+
+    def discard(self, error=False):
+        """Stop gpg2 and remove *output*. With *error*, raise a
+        :exc:`CryptoException` with gpg2's diagnostics afterwards."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.proc.poll() is None:
+                self.proc.kill()
+                self.proc.wait()
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                # The plaintext still buffered couldn't be flushed, as
+                # intended
+                pass
+            self._remove_output()
+            if error:
+                raise CryptoException(self._error())
+        finally:
+            self.stderr.close()
+
+    def _remove_output(self):
+        try:
+            os.remove(self.output)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def decrypt(secret, ciphertext, fingerprint=None):
     """
     >>> key = genkeypair('randomid', 'randomid')
     >>> decrypt('randomid',
     ...   encrypt('Goodbye, cruel world!', str(key))
     ... )
     'Goodbye, cruel world!'
+
+    :param str secret: The codename of the source the ciphertext was
+                       encrypted to.
+    :param str fingerprint: The fingerprint of their key, if known, which
+                            lets backends decrypt without gpg2.
+    """
+    hashed_codename = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
+    return backend.decrypt(hashed_codename, ciphertext, fingerprint)
+
+
+def decrypt_many(secret, ciphertexts, fingerprint=None):
+    """Decrypt all of *ciphertexts*, which were encrypted to the same source,
+    returning the plaintexts in the same order. Unlike calling
+    :func:`decrypt` for each of them, the passphrase is only derived from
+    the codename once, and backends may reuse the unlocked key.
+
+    Ciphertexts that cannot be decrypted give an empty string, as with
+    :func:`decrypt`.
     """
+    if not ciphertexts:
+        return []
     hashed_codename = hash_codename(secret, salt=SCRYPT_GPG_PEPPER)
-    return gpg.decrypt(ciphertext, passphrase=hashed_codename).data
+    return backend.decrypt_many(hashed_codename, ciphertexts, fingerprint)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -9,14 +9,13 @@ try:
 except:
     from StringIO import StringIO
 
-from sqlalchemy import create_engine, ForeignKey
+from sqlalchemy import create_engine, ForeignKey, inspect, literal
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean, DateTime, Binary
 from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 from jinja2 import Markup
 
-import scrypt
 import pyotp
 
 import qrcode
@@ -24,6 +23,7 @@ import qrcode
 import qrcode.image.svg
 
 import config
+import crypto_util
 import store
 
 
@@ -86,6 +86,17 @@ class Source(Base):
     # keep track of how many interactions have happened, for filenames
     interaction_count = Column(Integer, default=0, nullable=False)
 
+    # fingerprint of the source's reply keypair, set once it has been
+    # generated, so it doesn't have to be looked up in the keyring
+    fingerprint = Column(String(40))
+
+    # denormalized counts of the source's submissions, so listing sources
+    # doesn't have to load them. Kept up to date with `adjust_counts`.
+    message_count = Column(Integer, default=0, nullable=False)
+    document_count = Column(Integer, default=0, nullable=False)
+    unread_count = Column(Integer, default=0, nullable=False)
+    total_size = Column(Integer, default=0, nullable=False)
+
     # Don't create or bother checking excessively long codenames to prevent DoS
     NUM_WORDS = 7
     MAX_CODENAME_LEN = 128
@@ -104,17 +115,43 @@ class Source(Base):
             ' ', '_') if c in valid_chars])
 
     def documents_messages_count(self):
-        try:
-            return self.docs_msgs_count
-        except AttributeError:
-            self.docs_msgs_count = {'messages': 0, 'documents': 0}
-            for submission in self.submissions:
-                if submission.filename.endswith('msg.gpg'):
-                    self.docs_msgs_count['messages'] += 1
-                elif (submission.filename.endswith('doc.gz.gpg') or
-                      submission.filename.endswith('doc.zip.gpg')):
-                    self.docs_msgs_count['documents'] += 1
-            return self.docs_msgs_count
+        return {'messages': self.message_count,
+                'documents': self.document_count}
+
+    @staticmethod
+    def submission_counts(submissions):
+        """Return the contribution of *submissions* to the counters of
+        their source, as a dict of keyword arguments for
+        :meth:`adjust_counts`."""
+        counts = dict(message_count=0, document_count=0, unread_count=0,
+                      total_size=0)
+        for submission in submissions:
+            if submission.filename.endswith('msg.gpg'):
+                counts['message_count'] += 1
+            elif (submission.filename.endswith('doc.gz.gpg') or
+                  submission.filename.endswith('doc.zip.gpg')):
+                counts['document_count'] += 1
+            if not submission.downloaded:
+                counts['unread_count'] += 1
+            counts['total_size'] += submission.size
+        return counts
+
+    def adjust_counts(self, sign=1, **counts):
+        """Add (or, if *sign* is -1, subtract) *counts* to the counters of
+        this source. The counters are updated relative to their current
+        value in the database, and flushed immediately, so concurrent
+        requests don't overwrite each other's changes."""
+        for column, value in counts.items():
+            if value:
+                setattr(self, column,
+                        getattr(Source, column) + sign * value)
+        db_session.flush()
+
+    def recompute_counts(self):
+        """Reset the counters of this source from its submissions."""
+        for column, value in self.submission_counts(
+                self.submissions).items():
+            setattr(self, column, value)
 
     @property
     def collection(self):
@@ -143,7 +180,9 @@ class Submission(Base):
     def __init__(self, source, filename):
         self.source_id = source.id
         self.filename = filename
-        self.size = os.stat(store.path(source.filesystem_id, filename)).st_size
+        self.downloaded = False
+        self.size = os.stat(store.trusted_path(source.filesystem_id,
+                                               filename)).st_size
 
     def __repr__(self):
         return '<Submission %r>' % (self.filename)
@@ -173,7 +212,8 @@ class Reply(Base):
         self.journalist_id = journalist.id
         self.source_id = source.id
         self.filename = filename
-        self.size = os.stat(store.path(source.filesystem_id, filename)).st_size
+        self.size = os.stat(store.trusted_path(source.filesystem_id,
+                                               filename)).st_size
 
     def __repr__(self):
         return '<Reply %r>' % (self.filename)
@@ -289,7 +329,7 @@ class Journalist(Base):
     def _scrypt_hash(self, password, salt, params=None):
         if not params:
             params = self._SCRYPT_PARAMS
-        return scrypt.hash(str(password), salt, **params)
+        return crypto_util.scrypt_pool.hash(str(password), salt, **params)
 
     MAX_PASSWORD_LEN = 128
     MIN_PASSWORD_LEN = 14
@@ -470,3 +510,49 @@ class JournalistLoginAttempt(Base):
 # Declare (or import) models before init_db
 def init_db():
     Base.metadata.create_all(bind=engine)
+
+
+def _add_column_ddl(table, column):
+    """Return the ALTER TABLE statement adding *column* to *table*, or
+    raise ValueError if the column can't be added that way and needs a
+    proper migration.
+    """
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        table.name, column.name, column.type.compile(dialect=engine.dialect))
+    if column.default is None:
+        if not column.nullable or column.primary_key:
+            raise ValueError("can't add column {}.{} without a default".format(
+                table.name, column.name))
+        return ddl
+    if not column.default.is_scalar:
+        # e.g. datetime.datetime.utcnow, which only SQLAlchemy can call
+        raise ValueError("can't add column {}.{} with a non-constant "
+                         "default".format(table.name, column.name))
+    default = literal(column.default.arg, type_=column.type).compile(
+        dialect=engine.dialect, compile_kwargs={'literal_binds': True})
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    return ddl + ' DEFAULT {}'.format(default)
+
+
+def add_missing_columns():
+    """Add the columns declared on the models that are missing from a
+    database created by an earlier version of SecureDrop. Returns the list
+    of columns that were added, as ``table.column`` strings.
+
+    Raises ValueError, without changing the database, if a missing column
+    can't be added with ALTER TABLE.
+    """
+    missing = []
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                missing.append((table, column, _add_column_ddl(table, column)))
+
+    added = []
+    for table, column, ddl in missing:
+        engine.execute(ddl)
+        added.append('{}.{}'.format(table.name, column.name))
+    return added
@@ -6,7 +6,9 @@ from flask_assets import Environment
 from flask_babel import gettext
 from flask_wtf.csrf import CSRFProtect, CSRFError
 from os import path
+from werkzeug.exceptions import ServiceUnavailable
 
+import crypto_util
 import i18n
 import template_filters
 import version
@@ -36,6 +38,11 @@ def create_app(config):
         flash(msg, 'error')
         return redirect(url_for('main.login'))
 
+    @app.errorhandler(crypto_util.ScryptBusyException)
+    def handle_scrypt_busy(e):
+        return ServiceUnavailable(gettext(
+            'The server is busy. Please try again in a moment.'))
+
     i18n.setup_app(app)
 
     app.jinja_env.trim_blocks = True
@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 
 from flask import (Blueprint, redirect, url_for, render_template, flash,
-                   request, abort, send_file, current_app)
+                   request, abort, send_file, current_app, jsonify)
 from flask_babel import gettext
 from sqlalchemy.orm.exc import NoResultFound
 
-import crypto_util
 import store
 
 from db import db_session, Submission
@@ -13,7 +12,10 @@ from journalist_app.forms import ReplyForm
 from journalist_app.utils import (make_star_true, make_star_false, get_source,
                                   delete_collection, col_download_unread,
                                   col_download_all, col_star, col_un_star,
-                                  col_delete)
+                                  col_delete, get_source_filters,
+                                  get_filtered_filesystem_ids,
+                                  get_bulk_download_job, mark_downloaded,
+                                  mark_bulk_archive_downloaded)
 
 
 def make_blueprint(config):
@@ -35,7 +37,7 @@ def make_blueprint(config):
     def col(filesystem_id):
         form = ReplyForm()
         source = get_source(filesystem_id)
-        source.has_key = crypto_util.getkey(filesystem_id)
+        source.has_key = source.fingerprint is not None
         return render_template("col.html", filesystem_id=filesystem_id,
                                source=source, form=form)
 
@@ -54,20 +56,64 @@ def make_blueprint(config):
         actions = {'download-unread': col_download_unread,
                    'download-all': col_download_all, 'star': col_star,
                    'un-star': col_un_star, 'delete': col_delete}
-        if 'cols_selected' not in request.form:
+        if request.form.get('select_all_matching'):
+            # Apply the action to every source matching the filters of the
+            # index, not only to those on the current page
+            cols_selected = get_filtered_filesystem_ids(
+                get_source_filters(request.form))
+        else:
+            # getlist is cgi.FieldStorage.getlist
+            cols_selected = request.form.getlist('cols_selected')
+        if not cols_selected:
             flash(gettext('No collections selected.'), 'error')
             return redirect(url_for('main.index'))
 
-        # getlist is cgi.FieldStorage.getlist
-        cols_selected = request.form.getlist('cols_selected')
         action = request.form['action']
 
         if action not in actions:
             return abort(500)
 
+        if (action == 'delete' and request.form.get('select_all_matching') and
+                request.form.get('confirm_count') != str(len(cols_selected))):
+            # Without a filter this would delete every source, so make the
+            # journalist confirm how many sources are about to be deleted
+            return render_template('delete_collections.html',
+                                   count=len(cols_selected),
+                                   filters=get_source_filters(request.form))
+
         method = actions[action]
         return method(cols_selected)
 
+    @view.route('/download/<job_id>')
+    def bulk_download(job_id):
+        """Show the progress of a bulk download job, and a link to its
+        archive once it is ready."""
+        job = get_bulk_download_job(job_id)
+        done, total = job.meta.get('progress', (0, 0))
+        return render_template('bulk_download.html', job=job,
+                               status=job.get_status(), done=done,
+                               total=total)
+
+    @view.route('/download/<job_id>/status')
+    def bulk_download_status(job_id):
+        """Report the progress of a bulk download job, for polling."""
+        job = get_bulk_download_job(job_id)
+        done, total = job.meta.get('progress', (0, 0))
+        return jsonify(status=job.get_status(), done=done, total=total)
+
+    @view.route('/download/<job_id>/archive')
+    def bulk_download_archive(job_id):
+        """Send the archive built by a finished bulk download job. With
+        USE_X_SENDFILE, the web server sends it from config.TEMP_DIR."""
+        job = get_bulk_download_job(job_id)
+        if not job.is_finished:
+            abort(404)
+        mark_bulk_archive_downloaded(job)
+        return send_file(store.bulk_archive_path(job.id),
+                         mimetype="application/zip",
+                         attachment_filename=job.meta['filename'],
+                         as_attachment=True)
+
     @view.route('/<filesystem_id>/<fn>')
     def download_single_submission(filesystem_id, fn):
         """Sends a client the contents of a single submission."""
@@ -75,12 +121,13 @@ def make_blueprint(config):
             abort(404)
 
         try:
-            Submission.query.filter(
-                Submission.filename == fn).one().downloaded = True
-            db_session.commit()
+            submission = Submission.query.filter(
+                Submission.filename == fn).one()
         except NoResultFound as e:
             current_app.logger.error(
                 "Could not mark " + fn + " as downloaded: %s" % (e,))
+        else:
+            mark_downloaded([submission])
 
         return send_file(store.path(filesystem_id, fn),
                          mimetype="application/pgp-encrypted")
@@ -9,10 +9,12 @@ from sqlalchemy.sql.expression import false
 import crypto_util
 import store
 
-from db import db_session, Source, SourceStar, Submission, Reply
+from db import db_session, Submission, Reply
 from journalist_app.forms import ReplyForm
 from journalist_app.utils import (validate_user, bulk_delete, download,
-                                  confirm_bulk_delete, get_source)
+                                  confirm_bulk_delete, get_source,
+                                  get_sources_by_star, get_source_filters,
+                                  format_cursor, parse_cursor)
 
 
 def make_blueprint(config):
@@ -47,28 +49,22 @@ def make_blueprint(config):
 
     @view.route('/')
     def index():
-        unstarred = []
-        starred = []
-
-        # Long SQLAlchemy statements look best when formatted according to
-        # the Pocoo style guide, IMHO:
-        # http://www.pocoo.org/internal/styleguide/
-        sources = Source.query.filter_by(pending=False) \
-                              .order_by(Source.last_updated.desc()) \
-                              .all()
-        for source in sources:
-            star = SourceStar.query.filter_by(source_id=source.id).first()
-            if star and star.starred:
-                starred.append(source)
-            else:
-                unstarred.append(source)
-            source.num_unread = len(
-                Submission.query.filter_by(source_id=source.id,
-                                           downloaded=False).all())
+        filters = get_source_filters(request.args)
+        after = request.args.get('after')
+        if after:
+            after = parse_cursor(after)
+
+        starred, unstarred, next_page = get_sources_by_star(
+            filters, after=after,
+            limit=getattr(config, 'SOURCES_PER_PAGE', 100))
+        if next_page:
+            next_page = format_cursor(next_page)
 
         return render_template('index.html',
                                unstarred=unstarred,
-                               starred=starred)
+                               starred=starred,
+                               filters=filters,
+                               next_page=next_page)
 
     @view.route('/reply', methods=('POST',))
     def reply():
@@ -91,13 +87,20 @@ def make_blueprint(config):
                 flash(error, "error")
             return redirect(url_for('col.col', filesystem_id=g.filesystem_id))
 
+        if g.source.fingerprint is None:
+            # The reply keypair of the source hasn't been generated yet
+            flash(gettext("You cannot reply to this source until an "
+                          "encryption key has been generated for them."),
+                  "error")
+            return redirect(url_for('col.col', filesystem_id=g.filesystem_id))
+
         g.source.interaction_count += 1
         filename = "{0}-{1}-reply.gpg".format(g.source.interaction_count,
                                               g.source.journalist_filename)
-        crypto_util.encrypt(form.message.data,
-                            [crypto_util.getkey(g.filesystem_id),
-                             config.JOURNALIST_KEY],
-                            output=store.path(g.filesystem_id, filename))
+        with store.SourceLock(g.filesystem_id):
+            crypto_util.encrypt(form.message.data,
+                                [g.source.fingerprint, config.JOURNALIST_KEY],
+                                output=store.path(g.filesystem_id, filename))
         reply = Reply(g.user, g.source, filename)
 
         try:
@@ -174,15 +177,15 @@ def make_blueprint(config):
 
     @view.route('/download_unread/<filesystem_id>')
     def download_unread_filesystem_id(filesystem_id):
-        id = Source.query.filter(Source.filesystem_id == filesystem_id) \
-            .one().id
+        # With the source loaded first, submission.source is found in the
+        # session instead of being queried for while building the archive
+        source = get_source(filesystem_id)
         submissions = Submission.query.filter(
-            Submission.source_id == id,
+            Submission.source_id == source.id,
             Submission.downloaded == false()).all()
         if submissions == []:
             flash(gettext("No unread submissions for this source."))
             return redirect(url_for('col.col', filesystem_id=filesystem_id))
-        source = get_source(filesystem_id)
         return download(source.journalist_filename, submissions)
 
     return view
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+import uuid
+
 from flask import (g, flash, current_app, abort, send_file, redirect, url_for,
-                   render_template, Markup)
+                   render_template, Markup, Response, stream_with_context)
 from flask_babel import gettext, ngettext
-from sqlalchemy.sql.expression import false
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.sql.expression import false, true
 
+import config
 import crypto_util
 import i18n
 import store
@@ -15,7 +20,6 @@ from db import (db_session, get_one_or_else, Source, Journalist,
                 InvalidUsernameException, WrongPasswordException,
                 LoginThrottledException, BadTokenException, SourceStar,
                 PasswordError, Submission)
-from rm import srm
 
 
 def logged_in():
@@ -55,6 +59,117 @@ def get_source(filesystem_id):
     return source
 
 
+# Format of the cursor used to paginate the journalist index
+CURSOR_TIMESTAMP_FORMAT = '%Y%m%dT%H%M%S.%f'
+
+
+def get_source_filters(args):
+    """Return the filters on the journalist's list of sources set in the
+    request *args* (``request.args`` or ``request.form``), as a dict with
+    any of the keys ``starred``, ``unread`` and ``flagged`` (set to True)
+    and ``designation`` (a journalist designation prefix).
+    """
+    filters = {}
+    for name in ('starred', 'unread', 'flagged'):
+        if args.get(name):
+            filters[name] = True
+    designation = args.get('designation', '').strip()
+    if designation:
+        filters['designation'] = designation
+    return filters
+
+
+def format_cursor(cursor):
+    """Serialize a ``(last_updated, id)`` pagination cursor for use in a
+    URL."""
+    last_updated, source_id = cursor
+    return '{}_{}'.format(last_updated.strftime(CURSOR_TIMESTAMP_FORMAT),
+                          source_id)
+
+
+def parse_cursor(value):
+    """Parse a pagination cursor serialized by :func:`format_cursor`,
+    aborting with a 400 error if it is malformed."""
+    try:
+        last_updated, source_id = value.split('_')
+        return (datetime.strptime(last_updated, CURSOR_TIMESTAMP_FORMAT),
+                int(source_id))
+    except ValueError:
+        abort(400)
+
+
+def _query_sources(filters):
+    """Return a query on the non-pending sources matching *filters* (see
+    :func:`get_source_filters`). Stars are outer joined so they can be
+    eagerly loaded.
+    """
+    query = Source.query.outerjoin(Source.star) \
+                        .filter(Source.pending == false())
+
+    if filters.get('starred'):
+        query = query.filter(SourceStar.starred == true())
+    if filters.get('unread'):
+        query = query.filter(Source.unread_count > 0)
+    if filters.get('flagged'):
+        query = query.filter(Source.flagged == true())
+    if filters.get('designation'):
+        prefix = filters['designation'].lower()
+        for special in ('\\', '%', '_'):
+            prefix = prefix.replace(special, '\\' + special)
+        query = query.filter(
+            Source.journalist_designation.like(prefix + '%', escape='\\'))
+    return query
+
+
+def get_sources_by_star(filters=None, after=None, limit=None):
+    """Return a page of the non-pending sources matching *filters*, most
+    recently updated first, as a ``(starred, unstarred, next_page)``
+    tuple.
+
+    The star of each source is loaded by the same query, and the counts of
+    submissions are read from the source's counters, so listing sources
+    doesn't query their submissions.
+
+    Pages are selected with a keyset on ``(last_updated, id)``: *after* is
+    the cursor of the previous page's last source, and *next_page* is the
+    cursor of this page's last source, or None if this is the last page.
+    """
+    query = _query_sources(filters or {}) \
+        .options(contains_eager(Source.star)) \
+        .order_by(Source.last_updated.desc(), Source.id.desc())
+    if after:
+        last_updated, source_id = after
+        query = query.filter(or_(
+            Source.last_updated < last_updated,
+            and_(Source.last_updated == last_updated,
+                 Source.id < source_id)))
+    if limit:
+        # Fetch one more row than needed to know if there is another page
+        query = query.limit(limit + 1)
+    sources = query.all()
+
+    next_page = None
+    if limit and len(sources) > limit:
+        sources = sources[:limit]
+        next_page = (sources[-1].last_updated, sources[-1].id)
+
+    starred = []
+    unstarred = []
+    for source in sources:
+        if source.star and source.star.starred:
+            starred.append(source)
+        else:
+            unstarred.append(source)
+    return starred, unstarred, next_page
+
+
+def get_filtered_filesystem_ids(filters):
+    """Return the filesystem ids of all the sources matching *filters*,
+    regardless of pagination."""
+    query = _query_sources(filters).with_entities(Source.filesystem_id)
+    return [filesystem_id for filesystem_id, in query]
+
+
 def validate_user(username, password, token, error_message=None):
     """
     Validates the user by calling the login and handling exceptions
@@ -102,37 +217,185 @@ def validate_user(username, password, token, error_message=None):
         return None
 
 
+# SQLite refuses statements with more than 999 parameters, so long `IN`
+# clauses are split into chunks of at most this many values
+IN_CLAUSE_CHUNK_SIZE = 500
+
+
+def chunks(values, size=IN_CLAUSE_CHUNK_SIZE):
+    """Split the list *values* into lists of at most *size* items."""
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
 def download(zip_basename, submissions):
     """Send client contents of ZIP-file *zip_basename*-<timestamp>.zip
-    containing *submissions*. The ZIP-file, being a
-    :class:`tempfile.NamedTemporaryFile`, is stored on disk only
-    temporarily.
+    containing *submissions*.
+
+    The ZIP-file is streamed to the client as it is generated, and the
+    submissions are marked as downloaded once all of it has been sent.
+    With ``USE_X_SENDFILE``, it is instead written to a
+    :class:`tempfile.NamedTemporaryFile` in ``config.TEMP_DIR`` and sent
+    with :func:`flask.send_file`, so the web server can send it.
+    If ``config.ASYNC_BULK_DOWNLOADS`` is True, the ZIP-file is built by
+    the worker instead, and the client is redirected to a page following
+    the progress of the job (see :func:`enqueue_bulk_archive`). The
+    submissions are then only marked as downloaded once the archive is
+    (see :func:`mark_bulk_archive_downloaded`).
 
     :param str zip_basename: The basename of the ZIP-file download.
 
     :param list submissions: A list of :class:`db.Submission`s to
-                             include in the ZIP-file.
+                             include in the ZIP-file, whose sources are
+                             already loaded (see :func:`get_submissions`).
     """
-    zf = store.get_bulk_archive(submissions,
-                                zip_directory=zip_basename)
     attachment_filename = "{}--{}.zip".format(
         zip_basename, datetime.utcnow().strftime("%Y-%m-%d--%H-%M-%S"))
+    if getattr(config, 'ASYNC_BULK_DOWNLOADS', False):
+        job = enqueue_bulk_archive(attachment_filename, submissions,
+                                   zip_directory=zip_basename)
+        return redirect(url_for('col.bulk_download', job_id=job.id))
+
+    if not current_app.config['USE_X_SENDFILE']:
+        archive = store.stream_bulk_archive(submissions,
+                                            zip_directory=zip_basename)
+        return Response(
+            stream_with_context(_mark_downloaded_when_sent(archive,
+                                                           submissions)),
+            mimetype="application/zip", direct_passthrough=True,
+            headers={'Content-Disposition':
+                     'attachment; filename={}'.format(attachment_filename)})
+
+    zf = store.get_bulk_archive(submissions,
+                                zip_directory=zip_basename)
 
     # Mark the submissions that have been downloaded as such
-    for submission in submissions:
-        submission.downloaded = True
-    db_session.commit()
+    mark_downloaded(submissions)
 
     return send_file(zf.name, mimetype="application/zip",
                      attachment_filename=attachment_filename,
                      as_attachment=True)
 
 
+def _mark_downloaded_when_sent(archive, submissions):
+    """Yield the chunks of *archive*, then mark *submissions* as
+    downloaded. If the client goes away before the end of the archive,
+    the generator is closed and they stay unread."""
+    for chunk in archive:
+        yield chunk
+    mark_downloaded(submissions)
+
+
+# How long, in seconds, the worker keeps the status of bulk download jobs
+# around. Their archives are removed from config.TEMP_DIR by `manage.py
+# clean-tmp`.
+BULK_DOWNLOAD_RESULT_TTL = 24 * 60 * 60
+
+
+def enqueue_bulk_archive(attachment_filename, submissions, zip_directory=''):
+    """Enqueue a job writing a ZIP-file of *submissions* to
+    ``config.TEMP_DIR``, and return it.
+
+    The archive's entries are resolved here, so the worker doesn't need a
+    database session. The job's metadata records the journalist it belongs
+    to, the name the archive is downloaded as, the submissions to mark as
+    downloaded once it is, and the progress made.
+    """
+    entries = store.bulk_archive_entries(submissions, zip_directory)
+    job_id = str(uuid.uuid4())
+    return worker.enqueue(store.write_bulk_archive, entries,
+                          store.bulk_archive_path(job_id),
+                          progress=worker.report_progress,
+                          job_id=job_id,
+                          result_ttl=BULK_DOWNLOAD_RESULT_TTL,
+                          meta={'journalist_id': g.user.id,
+                                'filename': attachment_filename,
+                                'submission_ids': [
+                                    submission.id
+                                    for submission in submissions
+                                    if isinstance(submission, Submission)],
+                                'progress': (0, len(entries))})
+
+
+def get_bulk_download_job(job_id):
+    """Return the bulk download job *job_id* of the logged in journalist,
+    or abort with a 404 if there is no such job."""
+    job = worker.fetch_job(job_id)
+    if (job is None or not store.VALIDATE_BULK_ARCHIVE_JOB_ID(job.id) or
+            job.meta.get('journalist_id') != g.user.id):
+        abort(404)
+    return job
+
+
+def mark_bulk_archive_downloaded(job):
+    """Mark the submissions in the archive of the finished bulk download
+    *job* as downloaded, as it is sent. Those deleted since are skipped."""
+    submissions = []
+    for chunk in chunks(job.meta.get('submission_ids', [])):
+        submissions.extend(
+            Submission.query.filter(Submission.id.in_(chunk)).all())
+    mark_downloaded(submissions)
+
+
+def mark_downloaded(submissions):
+    """Mark *submissions* as downloaded, and update the unread counts of
+    their sources accordingly. Replies, which may be downloaded along
+    with them, are left alone.
+
+    Rather than flushing every submission and source separately, this
+    issues one ``UPDATE submissions ... WHERE id IN (...)`` and one
+    ``UPDATE sources`` (per chunk of ids) in a single transaction. The
+    unread counts are recounted from the submissions, so submissions
+    another request marked as downloaded in the meantime aren't counted
+    twice."""
+    unread = {}
+    for submission in submissions:
+        if isinstance(submission, Submission) and not submission.downloaded:
+            unread[submission.id] = submission.source_id
+    if not unread:
+        return
+
+    for chunk in chunks(list(unread)):
+        Submission.query.filter(Submission.id.in_(chunk),
+                                Submission.downloaded == false()).update(
+            {Submission.downloaded: True}, synchronize_session=False)
+    recount_unread(set(unread.values()))
+    # Committing expires the loaded instances, so they pick up the values
+    # written by the bulk updates above
+    db_session.commit()
+
+
+def recount_unread(source_ids):
+    """Set the unread counts of the sources *source_ids* from their
+    submissions, in the database, rather than adjusting them from
+    submissions loaded earlier, which a concurrent request may have marked
+    as downloaded since."""
+    unread_count = db_session.query(func.count(Submission.id)).filter(
+        Submission.source_id == Source.id,
+        Submission.downloaded == false()).correlate(Source).as_scalar()
+    for chunk in chunks(list(source_ids)):
+        Source.query.filter(Source.id.in_(chunk)).update(
+            {Source.unread_count: unread_count}, synchronize_session=False)
+
+
 def bulk_delete(filesystem_id, items_selected):
+    submissions = [item for item in items_selected
+                   if isinstance(item, Submission)]
+    if submissions:
+        source = get_source(filesystem_id)
+        counts = Source.submission_counts(submissions)
+        # Recounted below instead
+        del counts['unread_count']
+        source.adjust_counts(sign=-1, **counts)
+
+    # A single job for all of them, rather than flooding the queue
+    worker.enqueue(store.secure_delete, filesystem_id,
+                   [item.filename for item in items_selected],
+                   progress=worker.report_progress)
     for item in items_selected:
-        item_path = store.path(filesystem_id, item.filename)
-        worker.enqueue(srm, item_path)
         db_session.delete(item)
+    if submissions:
+        db_session.flush()
+        recount_unread([source.id])
     db_session.commit()
 
     flash(ngettext("Submission deleted.",
@@ -210,7 +473,8 @@ def make_password():
 
 def delete_collection(filesystem_id):
     # Delete the source's collection of submissions
-    job = worker.enqueue(srm, store.path(filesystem_id))
+    job = worker.enqueue(store.secure_delete, filesystem_id,
+                         progress=worker.report_progress)
 
     # Delete the source's reply keypair
     crypto_util.delete_reply_keypair(filesystem_id)
@@ -249,15 +513,24 @@ def set_diceware_password(user, password):
         'success')
 
 
+def get_submissions(cols_selected, unread_only=False):
+    """Return the submissions of the sources with the filesystem ids in
+    *cols_selected*, with their sources eagerly loaded, using one query per
+    chunk of ids rather than two queries per source."""
+    submissions = []
+    for chunk in chunks(list(cols_selected)):
+        query = Submission.query.join(Submission.source) \
+            .options(contains_eager(Submission.source)) \
+            .filter(Source.filesystem_id.in_(chunk))
+        if unread_only:
+            query = query.filter(Submission.downloaded == false())
+        submissions.extend(query.order_by(Submission.id).all())
+    return submissions
+
+
 def col_download_unread(cols_selected):
     """Download all unread submissions from all selected sources."""
-    submissions = []
-    for filesystem_id in cols_selected:
-        id = Source.query.filter(Source.filesystem_id == filesystem_id) \
-                   .one().id
-        submissions += Submission.query.filter(
-            Submission.downloaded == false(),
-            Submission.source_id == id).all()
+    submissions = get_submissions(cols_selected, unread_only=True)
     if submissions == []:
         flash(gettext("No unread submissions in selected collections."),
               "error")
@@ -267,10 +540,5 @@ def col_download_unread(cols_selected):
 
 def col_download_all(cols_selected):
     """Download all submissions from all selected sources."""
-    submissions = []
-    for filesystem_id in cols_selected:
-        id = Source.query.filter(Source.filesystem_id == filesystem_id) \
-                   .one().id
-        submissions += Submission.query.filter(
-            Submission.source_id == id).all()
+    submissions = get_submissions(cols_selected)
     return download("all", submissions)
@@ -15,13 +15,15 @@ import traceback
 import version
 
 import qrcode
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 
 os.environ['SECUREDROP_ENV'] = 'dev'  # noqa
 import config
 import crypto_util
-from db import (db_session, init_db, Journalist, PasswordError,
-                InvalidUsernameException)
+import store
+from db import (db_session, init_db, add_missing_columns, Journalist,
+                PasswordError, InvalidUsernameException, Source)
 from management.run import run
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
@@ -98,7 +100,7 @@ def reset(args):
         for source_dir in os.listdir(config.STORE_DIR):
             try:
                 # Each entry in STORE_DIR is a directory corresponding
-                # to a source
+                # to a source, or to a shard of them (see store.shard)
                 shutil.rmtree(os.path.join(config.STORE_DIR, source_dir))
             except OSError:
                 pass
@@ -255,6 +257,84 @@ def delete_user(args):
     return 0
 
 
+def backfill_fingerprints(args):
+    """Record in the database the fingerprint of the reply keypair of
+    every source whose keypair was generated before fingerprints were
+    stored there.
+    """
+    for column in add_missing_columns():
+        log.info('added column {}'.format(column))
+
+    count = 0
+    for source in Source.query.filter(Source.fingerprint.is_(None)):
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        if fingerprint:
+            source.fingerprint = fingerprint
+            count += 1
+    db_session.commit()
+    log.info('{} fingerprints recorded'.format(count))
+    return 0
+
+
+def recompute_counts(args):
+    """Recompute the submission counters of every source from their
+    submissions, e.g. after upgrading from a version that did not keep
+    them.
+    """
+    for column in add_missing_columns():
+        log.info('added column {}'.format(column))
+
+    sources = Source.query.options(subqueryload(Source.submissions))
+    for source in sources:
+        source.recompute_counts()
+    db_session.commit()
+    return 0
+
+
+def fill_keypool(args):
+    """Generate reply keypairs ahead of time, up to the size of the pool
+    (``KEYPOOL_SIZE`` in config.py by default).
+    """
+    generated = crypto_util.fill_keypool(args.size)
+    log.info('generated {} keypairs, {} in the pool'.format(
+        generated, len(crypto_util.pooled_keypairs())))
+    return 0
+
+
+def shard_store(args):
+    """Move the source directories of the store from the flat layout to the
+    sharded one (see :func:`store.source_dir`), *args.batch_size* at a time,
+    pausing *args.pause* seconds in between.
+
+    It can be run while the web applications are running, as long as they
+    were restarted with ``STORE_LAYOUT = 'migrating'`` in config.py first.
+    Once it is done, ``STORE_LAYOUT`` can be set to ``'sharded'``.
+    """
+    if getattr(config, 'STORE_LAYOUT', 'flat') == 'flat':
+        log.error("Set STORE_LAYOUT to 'migrating' in config.py, and restart "
+                  "the web applications, first")
+        return 1
+
+    filesystem_ids = [name for name in os.listdir(config.STORE_DIR)
+                      if store.VALIDATE_FILESYSTEM_ID(name) and
+                      not store.is_shard(name) and
+                      os.path.isdir(os.path.join(config.STORE_DIR, name))]
+    failed = 0
+    for i in range(0, len(filesystem_ids), args.batch_size):
+        for filesystem_id in filesystem_ids[i:i + args.batch_size]:
+            try:
+                store.move_to_shard(filesystem_id)
+            except OSError as e:
+                log.error('could not move {}: {}'.format(filesystem_id, e))
+                failed += 1
+        done = min(i + args.batch_size, len(filesystem_ids))
+        log.info('{} of {} source directories moved'.format(
+            done - failed, len(filesystem_ids)))
+        if done < len(filesystem_ids):
+            time.sleep(args.pause)
+    return 1 if failed else 0
+
+
 def clean_tmp(args):  # pragma: no cover
     """Cleanup the SecureDrop temp directory. """
     if not os.path.exists(args.directory):
@@ -412,6 +492,31 @@ def get_args():
     reset_subp = subps.add_parser('reset', help='DANGER!!! Clears the '
                                   "SecureDrop application's state.")
     reset_subp.set_defaults(func=reset)
+    # Record the fingerprints of the existing reply keypairs
+    backfill_subp = subps.add_parser('backfill-fingerprints', help='Store '
+                                     'the fingerprints of existing reply '
+                                     'keypairs in the database.')
+    backfill_subp.set_defaults(func=backfill_fingerprints)
+    # Recompute the denormalized submission counters of the sources
+    counts_subp = subps.add_parser('recompute-counts', help='Recompute the '
+                                   'submission counters of all sources.')
+    counts_subp.set_defaults(func=recompute_counts)
+    # Pre-generate reply keypairs
+    keypool_subp = subps.add_parser('fill-keypool', help='Generate reply '
+                                    'keypairs ahead of time.')
+    keypool_subp.add_argument('--size', type=int, default=None,
+                              help='Number of keypairs to keep in the pool '
+                              '(default: KEYPOOL_SIZE)')
+    keypool_subp.set_defaults(func=fill_keypool)
+    # Move the store to the sharded layout
+    shard_subp = subps.add_parser('shard-store', help='Move the source '
+                                  'directories of the store to the sharded '
+                                  'layout.')
+    shard_subp.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of directories moved at a time')
+    shard_subp.add_argument('--pause', type=float, default=1,
+                            help='Seconds to pause between batches')
+    shard_subp.set_defaults(func=shard_store)
     # Cleanup the SD temp dir
     set_clean_tmp_parser(subps, 'clean-tmp')
     set_clean_tmp_parser(subps, 'clean_tmp')
@@ -1,23 +1,69 @@
 from io import BytesIO
+from threading import Lock
 
 from flask import wrappers
 
+import config
 from secure_tempfile import SecureTemporaryFile
 
 
+class MemoryBudget(object):
+    """Account for the memory used by the uploads of all the requests
+    being handled by the process, so it stays under *limit* bytes."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.lock = Lock()
+
+    def reserve(self, size):
+        """Reserve *size* bytes, and return True, if that doesn't exceed
+        the limit."""
+        with self.lock:
+            if self.used + size > self.limit:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+
+#: Uploads up to this size are kept in memory, rather than encrypted to disk
+IN_MEMORY_THRESHOLD = getattr(config, 'UPLOAD_IN_MEMORY_THRESHOLD', 512 * 1024)
+
+#: Uploads kept in memory, by all the requests being handled at once
+in_memory_budget = MemoryBudget(
+    getattr(config, 'UPLOAD_IN_MEMORY_BUDGET', 64 * 1024 * 1024))
+
+
 class RequestThatSecuresFileUploads(wrappers.Request):
 
+    #: Set, before the form is parsed, to a callable that takes the name of
+    #: an uploaded file and returns a file-like object to stream it to,
+    #: e.g. a :class:`store.EncryptedUpload`, instead of buffering it.
+    upload_stream_factory = None
+
     def _secure_file_stream(self, total_content_length, content_type,
                             filename=None, content_length=None):
         """Storage class for data streamed in from requests.
 
-        If the data is relatively small (512KB), just store it in
-        memory. Otherwise, use the SecureTemporaryFile class to buffer
-        it on disk, encrypted with an ephemeral key to mitigate
-        forensic recovery of the plaintext.
+        If the data is relatively small (:data:`IN_MEMORY_THRESHOLD`),
+        and the uploads of the requests being handled don't already use
+        up :data:`in_memory_budget`, just store it in memory. Otherwise,
+        use the SecureTemporaryFile class to buffer it on disk,
+        encrypted with an ephemeral key to mitigate forensic recovery of
+        the plaintext.
 
         """
-        if total_content_length > 1024 * 512:
+        if filename and self.upload_stream_factory is not None:
+            stream = self.upload_stream_factory(filename)
+            # Closed along with the request, even if parsing the rest of
+            # the form fails and it never makes it into `files`
+            self.__dict__.setdefault('_upload_streams', []).append(stream)
+            return stream
+        if not self._reserve_upload_memory(total_content_length):
             # We don't use `config.TEMP_DIR` here because that
             # directory is exposed via X-Send-File and there is no
             # reason for these files to be publicly accessible. See
@@ -27,6 +73,18 @@ class RequestThatSecuresFileUploads(wrappers.Request):
             return SecureTemporaryFile('/tmp')
         return BytesIO()
 
+    def _reserve_upload_memory(self, total_content_length):
+        # The files of a request add up to at most its content length, so
+        # it is reserved once, for all of them, until the request is closed
+        if '_upload_memory' in self.__dict__:
+            return True
+        if (total_content_length is None or
+                total_content_length > IN_MEMORY_THRESHOLD or
+                not in_memory_budget.reserve(total_content_length)):
+            return False
+        self.__dict__['_upload_memory'] = total_content_length
+        return True
+
     def make_form_data_parser(self):
         return self.form_data_parser_class(self._secure_file_stream,
                                            self.charset,
@@ -34,3 +92,10 @@ class RequestThatSecuresFileUploads(wrappers.Request):
                                            self.max_form_memory_size,
                                            self.max_content_length,
                                            self.parameter_storage_class)
+
+    def close(self):
+        super(RequestThatSecuresFileUploads, self).close()
+        for stream in self.__dict__.get('_upload_streams', ()):
+            stream.close()
+        if '_upload_memory' in self.__dict__:
+            in_memory_budget.release(self.__dict__.pop('_upload_memory'))
@@ -16,9 +16,205 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import subprocess
+import binascii
+import os
 
+import config
 
-def srm(fn):
-    subprocess.check_call(['srm', '-r', fn])
+# The 27 patterns of Peter Gutmann's "Secure Deletion of Data from Magnetic
+# and Solid-State Memory"
+GUTMANN_PATTERNS = [
+    '\x55', '\xaa', '\x92\x49\x24', '\x49\x24\x92', '\x24\x92\x49',
+    '\x00', '\x11', '\x22', '\x33', '\x44', '\x55', '\x66', '\x77',
+    '\x88', '\x99', '\xaa', '\xbb', '\xcc', '\xdd', '\xee', '\xff',
+    '\x92\x49\x24', '\x49\x24\x92', '\x24\x92\x49', '\x6d\xb6\xdb',
+    '\xb6\xdb\x6d', '\xdb\x6d\xb6',
+]
+
+#: The passes of ``srm`` from secure-delete, which files used to be deleted
+#: with: 0xff, 5 random passes, the Gutmann patterns, then 5 random passes.
+#: None stands for random data.
+SRM_PASSES = ['\xff'] + [None] * 5 + GUTMANN_PATTERNS + [None] * 5
+
+#: Passes written over each file before it is deleted. Any number other than
+#: that of :data:`SRM_PASSES` means that many passes of random data.
+PASSES = getattr(config, 'SECURE_DELETE_PASSES', len(SRM_PASSES))
+
+#: Size of the writes, a multiple of the size of filesystem blocks, and of
+#: the length of the patterns so they repeat seamlessly from one to the next
+BLOCK_SIZE = 3 * 256 * 1024
+
+#: Number of files overwritten together, so they are synced to disk together
+#: after each pass
+BATCH_SIZE = 64
+
+
+class SecureDeletionError(Exception):
+    """Raised once :func:`srm_many` has deleted everything it could, with
+    the ``(path, error)`` of each of the paths it couldn't delete in
+    :attr:`failures`."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        super(SecureDeletionError, self).__init__(
+            "could not delete {} path(s): {}".format(
+                len(failures),
+                "; ".join("{}: {}".format(path, error)
+                          for path, error in failures)))
+
+
+def srm(fn, passes=None, progress=None):
+    """Securely delete the file, or directory tree, *fn*.
+
+    See :func:`srm_many`.
+    """
+    return srm_many([fn], passes, progress)
+
+
+def srm_many(paths, passes=None, progress=None):
+    """Securely delete each of the files, or directory trees, *paths*.
+
+    Each file is overwritten *passes* times (by default
+    :data:`PASSES`), like ``srm`` did if that is the number of
+    :data:`SRM_PASSES`, or else with random data. It is synced to disk
+    after each pass, then renamed to a random name and removed.
+    Symbolic links are removed, but what they point to is left alone.
+
+    A path that can't be deleted doesn't stop the others from being
+    deleted: :exc:`SecureDeletionError` is raised at the end instead.
+
+    *progress*, if given, is called with the number of files deleted so
+    far and the total number of files, e.g. :func:`worker.report_progress`
+    when run by the worker.
+    """
+    if passes is None:
+        passes = PASSES
+    failures = []
+    files, links, dirs = [], [], []
+    for path in paths:
+        try:
+            walked = _walk(path)
+        except OSError as e:
+            failures.append((path, e))
+            continue
+        files.extend(walked[0])
+        links.extend(walked[1])
+        dirs.extend(walked[2])
+
+    for i in range(0, len(files), BATCH_SIZE):
+        failures.extend(_shred(files[i:i + BATCH_SIZE], passes))
+        if progress:
+            progress(min(i + BATCH_SIZE, len(files)), len(files))
+    for path in links:
+        _remove(os.unlink, path, failures)
+    # Deepest first
+    for path in dirs:
+        _remove(os.rmdir, path, failures)
+
+    if failures:
+        raise SecureDeletionError(failures)
     return "success"
+
+
+def _walk(fn):
+    """Return the files, symbolic links and directories (deepest first) of
+    the tree *fn*."""
+    if os.path.islink(fn):
+        return [], [fn], []
+    if not os.path.isdir(fn):
+        os.lstat(fn)  # Fail like srm if it doesn't exist
+        return [fn], [], []
+    files, links, dirs = [], [], []
+    for dirpath, dirnames, filenames in os.walk(fn, topdown=False):
+        # os.walk() doesn't descend into links to directories, but lists them
+        for name in filenames + dirnames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                links.append(path)
+            elif name in filenames:
+                files.append(path)
+        dirs.append(dirpath)
+    return files, links, dirs
+
+
+def _shred(paths, passes):
+    """Overwrite and remove the files *paths*, and return the
+    ``(path, error)`` of those that couldn't be."""
+    failures = []
+    fds = []
+    for path in paths:
+        try:
+            fds.append((path, os.open(path, os.O_WRONLY | os.O_NOFOLLOW)))
+        except OSError as e:
+            failures.append((path, e))
+    try:
+        sizes = [_aligned_size(fd) for _, fd in fds]
+        fds = [(path, fd, size) for (path, fd), size in zip(fds, sizes)]
+        for pattern in _patterns(passes):
+            if pattern is None:
+                block = os.urandom(BLOCK_SIZE)
+            else:
+                block = pattern * (BLOCK_SIZE // len(pattern))
+            block = memoryview(block)
+            fds = _each(fds, lambda fd, size: _write(fd, block, size),
+                        failures)
+            fds = _each(fds, lambda fd, size: os.fsync(fd), failures)
+        fds = _each(fds, lambda fd, size: os.ftruncate(fd, 0), failures)
+    finally:
+        for entry in fds:
+            os.close(entry[1])
+
+    for path, _, _ in fds:
+        # Don't leave the name behind in the directory either
+        hidden = os.path.join(os.path.dirname(path),
+                              binascii.hexlify(os.urandom(16)))
+        if _remove(os.rename, path, failures, hidden):
+            _remove(os.unlink, hidden, failures)
+    return failures
+
+
+def _patterns(passes):
+    """Return the pattern of each of *passes* passes, None for random
+    data."""
+    if passes == len(SRM_PASSES):
+        return SRM_PASSES
+    return [None] * passes
+
+
+def _each(fds, func, failures):
+    """Call *func* with the file descriptor and size of each of the files
+    *fds*, and return those it didn't fail for, closing the others."""
+    succeeded = []
+    for path, fd, size in fds:
+        try:
+            func(fd, size)
+        except OSError as e:
+            os.close(fd)
+            failures.append((path, e))
+        else:
+            succeeded.append((path, fd, size))
+    return succeeded
+
+
+def _remove(func, path, failures, *args):
+    try:
+        func(path, *args)
+        return True
+    except OSError as e:
+        failures.append((path, e))
+        return False
+
+
+def _aligned_size(fd):
+    """Return the size of the file *fd*, rounded up to whole filesystem
+    blocks, so its last block is overwritten entirely."""
+    st = os.fstat(fd)
+    block = st.st_blksize or 4096
+    return -(-st.st_size // block) * block
+
+
+def _write(fd, block, size):
+    os.lseek(fd, 0, os.SEEK_SET)
+    written = 0
+    while written < size:
+        written += os.write(fd, block[:min(BLOCK_SIZE, size - written)])
@@ -7,6 +7,56 @@ from gnupg._util import _STREAMLIKE_TYPES
 from Crypto.Cipher import AES
 from Crypto.Random import random
 from Crypto.Util import Counter
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+import config
+
+# Size of the chunks uploaded files are read, encrypted and written in as they
+# go through the form parser, gzip, SecureTemporaryFile and gpg2. Each chunk
+# costs a few Python-level calls and syscalls, so larger chunks mean higher
+# throughput, at the expense of the memory used by each upload.
+CHUNK_SIZE = getattr(config, 'UPLOAD_CHUNK_SIZE', 256 * 1024)
+
+
+class PyCryptoCTR(object):
+    """AES-CTR with PyCrypto, which doesn't use AES-NI. Kept as the
+    reference :class:`OpenSSLCTR` is checked and benchmarked against."""
+
+    name = 'pycrypto'
+
+    def __init__(self, key, iv):
+        counter = Counter.new(128, initial_value=iv)
+        self.cipher = AES.new(key, AES.MODE_CTR, counter=counter)
+
+    def encrypt(self, data):
+        return self.cipher.encrypt(data)
+
+    def decrypt(self, data):
+        return self.cipher.decrypt(data)
+
+
+class OpenSSLCTR(object):
+    """AES-CTR with OpenSSL, through cryptography, which uses AES-NI on
+    the CPUs that have it. Gives the same ciphertext as
+    :class:`PyCryptoCTR`."""
+
+    name = 'openssl'
+
+    def __init__(self, key, iv):
+        # The initial counter block, as a big-endian 128-bit integer
+        nonce = '{:032x}'.format(iv).decode('hex')
+        cipher = Cipher(algorithms.AES(key), modes.CTR(nonce),
+                        backend=default_backend())
+        self.context = cipher.encryptor()
+
+    def encrypt(self, data):
+        return self.context.update(data)
+
+    decrypt = encrypt
+
+
+AES_CTR = OpenSSLCTR
 
 
 class SecureTemporaryFile(_TemporaryFileWrapper, object):
@@ -31,7 +81,7 @@ class SecureTemporaryFile(_TemporaryFileWrapper, object):
     AES_key_size = 256
     AES_block_size = 128
 
-    def __init__(self, store_dir):
+    def __init__(self, store_dir, chunk_size=CHUNK_SIZE):
         """Generates an AES key and an initialization vector, and opens
         a file in the `store_dir` directory with a
         pseudorandomly-generated filename.
@@ -39,10 +89,18 @@ class SecureTemporaryFile(_TemporaryFileWrapper, object):
         Args:
             store_dir (str): the directory to create the secure
                 temporary file under.
+            chunk_size (int): the size of the chunks the file is
+                encrypted and decrypted in, whatever the size of the
+                writes and reads.
 
         Returns: self
         """
         self.last_action = 'init'
+        self.chunk_size = chunk_size
+        self.write_buffer = []
+        self.write_buffered = 0
+        self.read_buffer = ''
+        self.read_offset = 0
         self.create_key()
         self.tmp_file_id = base64.urlsafe_b64encode(os.urandom(32)).strip('=')
         self.filepath = os.path.join(store_dir,
@@ -64,12 +122,10 @@ class SecureTemporaryFile(_TemporaryFileWrapper, object):
 
     def initialize_cipher(self):
         """Creates the cipher-related objects needed for AES-CTR
-        encryption and decryption.
+        encryption and decryption, with :data:`AES_CTR`.
         """
-        self.ctr_e = Counter.new(self.AES_block_size, initial_value=self.iv)
-        self.ctr_d = Counter.new(self.AES_block_size, initial_value=self.iv)
-        self.encryptor = AES.new(self.key, AES.MODE_CTR, counter=self.ctr_e)
-        self.decryptor = AES.new(self.key, AES.MODE_CTR, counter=self.ctr_d)
+        self.encryptor = AES_CTR(self.key, self.iv)
+        self.decryptor = AES_CTR(self.key, self.iv)
 
     def write(self, data):
         """Write `data` to the secure temporary file. This method may be
@@ -84,7 +140,20 @@ class SecureTemporaryFile(_TemporaryFileWrapper, object):
         if isinstance(data, unicode):  # noqa
             data = data.encode('utf-8')
 
-        self.file.write(self.encryptor.encrypt(data))
+        # Small writes (e.g. from gzip) are coalesced, since AES-CTR is a
+        # stream cipher, encrypting them together gives the same ciphertext
+        self.write_buffer.append(data)
+        self.write_buffered += len(data)
+        if self.write_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Encrypt and write what has been written so far to disk."""
+        if self.write_buffer:
+            self.file.write(self.encryptor.encrypt(''.join(self.write_buffer)))
+            self.write_buffer = []
+            self.write_buffered = 0
+        self.file.flush()
 
     def read(self, count=None):
         """Read `data` from the secure temporary file. This method may
@@ -107,13 +176,29 @@ class SecureTemporaryFile(_TemporaryFileWrapper, object):
         if self.last_action == 'init':
             raise AssertionError('You must write before reading!')
         if self.last_action == 'write':
+            self.flush()
             self.seek(0, 0)
             self.last_action = 'read'
 
-        if count:
-            return self.decryptor.decrypt(self.file.read(count))
-        else:
-            return self.decryptor.decrypt(self.file.read())
+        if not count:
+            data = (self.read_buffer[self.read_offset:] +
+                    self.decryptor.decrypt(self.file.read()))
+            self.read_buffer = ''
+            self.read_offset = 0
+            return data
+
+        # Decrypt at least a chunk at a time, however little is asked for
+        # (python-gnupg reads 1KB at a time), and hand out the rest later
+        available = len(self.read_buffer) - self.read_offset
+        if available < count:
+            ciphertext = self.file.read(max(self.chunk_size,
+                                            count - available))
+            self.read_buffer = (self.read_buffer[self.read_offset:] +
+                                self.decryptor.decrypt(ciphertext))
+            self.read_offset = 0
+        data = self.read_buffer[self.read_offset:self.read_offset + count]
+        self.read_offset += len(data)
+        return data
 
 
 # python-gnupg will not recognize our SecureTemporaryFile as a stream-like type
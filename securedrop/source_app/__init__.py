@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from functools import partial
 from flask import (Flask, render_template, flash, Markup, request, g, session,
                    url_for, redirect)
 from flask_babel import gettext
@@ -32,6 +33,18 @@ def create_app(config):
     # take longer than an hour over Tor, we increase the valid window to 24h.
     app.config['WTF_CSRF_TIME_LIMIT'] = 60 * 60 * 24
 
+    # Registered before CSRFProtect, whose check parses the form, and with
+    # it any uploaded file
+    @app.before_request
+    def encrypt_uploads():
+        """Encrypt the files a source submits as they are uploaded."""
+        filesystem_id = session.get('filesystem_id')
+        if (request.endpoint == 'main.submit' and logged_in() and
+                filesystem_id and
+                path.isdir(store.trusted_path(filesystem_id))):
+            request.upload_stream_factory = partial(store.EncryptedUpload,
+                                                    filesystem_id)
+
     CSRFProtect(app)
 
     @app.errorhandler(CSRFError)
@@ -107,7 +120,13 @@ def create_app(config):
         # these common values.
         if logged_in():
             g.codename = session['codename']
-            g.filesystem_id = crypto_util.hash_codename(g.codename)
+            # The filesystem id is computed when the source logs in, and
+            # kept in the (signed) session so it isn't hashed again on every
+            # request. Sessions from before it was kept there lack it.
+            if 'filesystem_id' not in session:
+                session['filesystem_id'] = crypto_util.hash_codename(
+                    g.codename)
+            g.filesystem_id = session['filesystem_id']
             try:
                 g.source = Source.query \
                             .filter(Source.filesystem_id == g.filesystem_id) \
@@ -118,8 +137,8 @@ def create_app(config):
                     (e,))
                 del session['logged_in']
                 del session['codename']
+                del session['filesystem_id']
                 return redirect(url_for('main.index'))
-            g.loc = store.path(g.filesystem_id)
 
     @app.teardown_appcontext
     def shutdown_session(exception=None):
@@ -135,4 +154,8 @@ def create_app(config):
     def internal_error(error):
         return render_template('error.html'), 500
 
+    @app.errorhandler(crypto_util.ScryptBusyException)
+    def scrypt_busy(error):
+        return render_template('error.html'), 503
+
     return app
@@ -8,14 +8,15 @@ from flask_babel import gettext
 from sqlalchemy.exc import IntegrityError
 
 import crypto_util
+import i18n
 import store
+import worker
 
 from db import Source, db_session, Submission, Reply, get_one_or_else
-from rm import srm
 from source_app.decorators import login_required
-from source_app.utils import (logged_in, generate_unique_codename,
+from source_app.utils import (logged_in, codename_pool,
                               async_genkey, normalize_timestamps,
-                              valid_codename, get_entropy_estimate)
+                              get_filesystem_id, get_entropy_estimate)
 from source_app.forms import LoginForm
 
 
@@ -36,14 +37,19 @@ def make_blueprint(config):
                   "notification")
             return redirect(url_for('.lookup'))
 
-        codename = generate_unique_codename()
-        session['codename'] = codename
-        session['new_user'] = True
+        codename, filesystem_id = codename_pool.get(
+            current_app._get_current_object(), i18n.get_language())
+        session.update(codename=codename, filesystem_id=filesystem_id,
+                       new_user=True)
         return render_template('generate.html', codename=codename)
 
     @view.route('/create', methods=['POST'])
     def create():
-        filesystem_id = crypto_util.hash_codename(session['codename'])
+        # The filesystem id was computed along with the codename, unless the
+        # codename was generated before it was kept in the session
+        filesystem_id = session.get('filesystem_id')
+        if filesystem_id is None:
+            filesystem_id = crypto_util.hash_codename(session['codename'])
 
         source = Source(filesystem_id, crypto_util.display_id())
         db_session.add(source)
@@ -57,29 +63,37 @@ def make_blueprint(config):
 
             # Issue 2386: don't log in on duplicates
             del session['codename']
+            session.pop('filesystem_id', None)
             abort(500)
         else:
-            os.mkdir(store.path(filesystem_id))
+            os.makedirs(store.path(filesystem_id))
 
-        session['logged_in'] = True
+        session.update(filesystem_id=filesystem_id, logged_in=True)
         return redirect(url_for('.lookup'))
 
     @view.route('/lookup', methods=('GET',))
     @login_required
     def lookup():
+        ciphertexts = []
+        with store.SourceLock(g.filesystem_id):
+            for reply in g.source.replies:
+                reply_path = store.trusted_path(g.filesystem_id,
+                                                reply.filename)
+                with open(reply_path) as fh:
+                    ciphertexts.append(fh.read())
+                    reply.date = datetime.utcfromtimestamp(
+                        os.fstat(fh.fileno()).st_mtime)
+
         replies = []
-        for reply in g.source.replies:
-            reply_path = store.path(g.filesystem_id, reply.filename)
+        plaintexts = crypto_util.decrypt_many(g.codename, ciphertexts,
+                                              g.source.fingerprint)
+        for reply, plaintext in zip(g.source.replies, plaintexts):
             try:
-                reply.decrypted = crypto_util.decrypt(
-                    g.codename,
-                    open(reply_path).read()).decode('utf-8')
+                reply.decrypted = plaintext.decode('utf-8')
             except UnicodeDecodeError:
                 current_app.logger.error("Could not decode reply %s" %
                                          reply.filename)
             else:
-                reply.date = datetime.utcfromtimestamp(
-                    os.stat(reply_path).st_mtime)
                 replies.append(reply)
 
         # Sort the replies by date
@@ -88,7 +102,7 @@ def make_blueprint(config):
         # Generate a keypair to encrypt replies from the journalist
         # Only do this if the journalist has flagged the source as one
         # that they would like to reply to. (Issue #140.)
-        if not crypto_util.getkey(g.filesystem_id) and g.source.flagged:
+        if not g.source.fingerprint and g.source.flagged:
             async_genkey(g.filesystem_id, g.codename)
 
         return render_template(
@@ -97,8 +111,7 @@ def make_blueprint(config):
             replies=replies,
             flagged=g.source.flagged,
             new_user=session.get('new_user', None),
-            haskey=crypto_util.getkey(
-                g.filesystem_id))
+            haskey=g.source.fingerprint is not None)
 
     @view.route('/submit', methods=('POST',))
     @login_required
@@ -152,17 +165,22 @@ def make_blueprint(config):
                                   html_contents=html_contents)
             flash(Markup(msg), "success")
 
+        new_submissions = []
         for fname in fnames:
             submission = Submission(g.source, fname)
             db_session.add(submission)
+            new_submissions.append(submission)
+        g.source.adjust_counts(**Source.submission_counts(new_submissions))
 
         if g.source.pending:
             g.source.pending = False
 
             # Generate a keypair now, if there's enough entropy (issue #303)
-            # (gpg reads 300 bytes from /dev/random)
+            # (gpg reads 300 bytes from /dev/random), or if one can be taken
+            # from the pool
             entropy_avail = get_entropy_estimate()
-            if entropy_avail >= 2400:
+            if (entropy_avail >= crypto_util.MIN_KEYGEN_ENTROPY or
+                    crypto_util.pooled_keypairs()):
                 async_genkey(g.filesystem_id, g.codename)
                 current_app.logger.info("generating key, entropy: {}".format(
                     entropy_avail))
@@ -183,7 +201,8 @@ def make_blueprint(config):
         query = Reply.query.filter(
             Reply.filename == request.form['reply_filename'])
         reply = get_one_or_else(query, current_app.logger, abort)
-        srm(store.path(g.filesystem_id, reply.filename))
+        worker.enqueue(store.secure_delete, g.filesystem_id, [reply.filename],
+                       progress=worker.report_progress)
         db_session.delete(reply)
         db_session.commit()
 
@@ -199,8 +218,10 @@ def make_blueprint(config):
                                      "expected")
             return redirect(url_for('.lookup'))
 
+        worker.enqueue(store.secure_delete, g.filesystem_id,
+                       [reply.filename for reply in replies],
+                       progress=worker.report_progress)
         for reply in replies:
-            srm(store.path(g.filesystem_id, reply.filename))
             db_session.delete(reply)
         db_session.commit()
 
@@ -212,8 +233,10 @@ def make_blueprint(config):
         form = LoginForm()
         if form.validate_on_submit():
             codename = request.form['codename'].strip()
-            if valid_codename(codename):
-                session.update(codename=codename, logged_in=True)
+            filesystem_id = get_filesystem_id(codename)
+            if filesystem_id is not None:
+                session.update(codename=codename, filesystem_id=filesystem_id,
+                               logged_in=True)
                 return redirect(url_for('.lookup', from_login='1'))
             else:
                 current_app.logger.info(
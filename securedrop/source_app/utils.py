@@ -1,21 +1,27 @@
-import subprocess
+import os
+import Queue
+import time
 
 from datetime import datetime
 from flask import session, current_app, abort, g
-from threading import Thread
+from threading import current_thread, Event, Lock, Thread
 
+import config
 import crypto_util
 import i18n
 import store
+import worker
 
-from db import Source, db_session
+from db import Source, Submission, db_session
 
 
 def logged_in():
     return 'logged_in' in session
 
 
-def valid_codename(codename):
+def get_filesystem_id(codename):
+    """Return the filesystem id of the source with *codename*, or None if
+    there is no such source."""
     try:
         filesystem_id = crypto_util.hash_codename(codename)
     except crypto_util.CryptoException as e:
@@ -25,14 +31,24 @@ def valid_codename(codename):
         abort(500)
 
     source = Source.query.filter_by(filesystem_id=filesystem_id).first()
-    return source is not None
+    if source is None:
+        return None
+    return filesystem_id
 
 
-def generate_unique_codename():
-    """Generate random codenames until we get an unused one"""
+def generate_unique_codename(locale=None, background=False):
+    """Generate random codenames until we get an unused one, and return it
+    along with its filesystem id.
+
+    :param str locale: The language of the codename's words, by default
+                       the language of the current request.
+    :param bool background: Whether the codename is generated ahead of
+                            time, so its hash yields to requests.
+    """
+    if locale is None:
+        locale = i18n.get_language()
     while True:
-        codename = crypto_util.genrandomid(Source.NUM_WORDS,
-                                           i18n.get_language())
+        codename = crypto_util.genrandomid(Source.NUM_WORDS, locale)
 
         # The maximum length of a word in the wordlist is 9 letters and the
         # codename length is 7 words, so it is currently impossible to
@@ -47,27 +63,213 @@ def generate_unique_codename():
                     "(Codename='{}')".format(codename))
             continue
 
-        filesystem_id = crypto_util.hash_codename(codename)  # scrypt (slow)
+        filesystem_id = crypto_util.hash_codename(  # scrypt (slow)
+            codename, background=background)
         matching_sources = Source.query.filter(
             Source.filesystem_id == filesystem_id).all()
         if len(matching_sources) == 0:
-            return codename
+            return codename, filesystem_id
+
+
+class CodenamePool(object):
+    """Keep up to *size* unused codenames per locale ready for /generate.
+
+    Generating a codename takes a (slow) scrypt hash and a query making
+    sure it isn't in use yet, so a background thread does it ahead of time
+    for each locale codenames have been asked for. The pooled codenames
+    only ever live in memory, and each of them is handed out at most once:
+    a codename that isn't used to create a source is simply dropped.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.queues = {}
+        self.pooled = set()
+        self.lock = Lock()
+        self.wanted = Event()
+        self.stopping = False
+        self.thread = None
+
+    def get(self, app, locale):
+        """Return an unused ``(codename, filesystem_id)`` for *locale*,
+        from the pool if it has one ready, or else generated right away."""
+        if self.size <= 0:
+            return generate_unique_codename(locale)
+        with self.lock:
+            queue = self.queues.setdefault(locale,
+                                           Queue.Queue(maxsize=self.size))
+            self._start_thread(app)
+        self.wanted.set()
+        try:
+            codename, filesystem_id = queue.get_nowait()
+        except Queue.Empty:
+            return generate_unique_codename(locale)
+        with self.lock:
+            self.pooled.discard(filesystem_id)
+        return codename, filesystem_id
+
+    def _start_thread(self, app):
+        # Started when first needed, so it isn't lost when mod_wsgi forks
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = Thread(target=self._run, args=(app,))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop the thread filling the pool, once it is done with the
+        codename it is generating."""
+        self.stopping = True
+        self.wanted.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self, app):
+        while True:
+            self.wanted.wait()
+            self.wanted.clear()
+            if self.stopping:
+                return
+            with app.app_context():
+                try:
+                    self._fill()
+                except Exception as e:
+                    app.logger.error(
+                        "Could not fill the codename pool: {}".format(e))
+                    # Try again later rather than spinning on the error
+                    time.sleep(1)
+                    self.wanted.set()
+
+    def _fill(self):
+        with self.lock:
+            queues = self.queues.items()
+        for locale, queue in queues:
+            # This thread is the only one filling the queues, so putting
+            # into a queue that isn't full doesn't block
+            while not queue.full():
+                codename, filesystem_id = generate_unique_codename(
+                    locale, background=True)
+                with self.lock:
+                    if filesystem_id in self.pooled:
+                        continue
+                    self.pooled.add(filesystem_id)
+                queue.put((codename, filesystem_id))
+
+
+# Disabled by default in tests, which depend on the codenames being
+# generated in the request
+codename_pool = CodenamePool(
+    size=getattr(config, 'CODENAME_POOL_SIZE',
+                 0 if os.environ.get('SECUREDROP_ENV') == 'test' else 10))
 
 
 def get_entropy_estimate():
-    return int(open('/proc/sys/kernel/random/entropy_avail').read())
+    return crypto_util.get_entropy_estimate()
 
 
-def async(f):
-    def wrapper(*args, **kwargs):
-        thread = Thread(target=f, args=args, kwargs=kwargs)
-        thread.start()
-    return wrapper
+class KeyGenerationPool(object):
+    """Generate the reply keypairs of sources on at most *workers* threads.
+
+    Generating a 4096-bit keypair takes a while and drains the entropy
+    pool, so rather than starting a thread per request, requests for a
+    source whose keypair is already pending are coalesced, and at most
+    *max_queued* requests wait for a thread. The threads are started when
+    first needed, so they aren't lost when mod_wsgi forks the process.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize=max_queued)
+        self.pending = set()
+        self.lock = Lock()
+        self.threads = []
+
+    def depth(self):
+        """Return the number of keypairs waiting for a thread."""
+        return self.queue.qsize()
+
+    def submit(self, app, filesystem_id, codename):
+        """Queue the generation of the keypair of *filesystem_id*, unless
+        it is already pending. Return False if the queue is full."""
+        with self.lock:
+            if filesystem_id in self.pending:
+                return True
+            try:
+                self.queue.put_nowait((app, filesystem_id, codename))
+            except Queue.Full:
+                return False
+            self.pending.add(filesystem_id)
+            self._start_threads()
+        return True
+
+    def _start_threads(self):
+        # Threads inherited from the parent process don't run after a fork
+        self.threads = [thread for thread in self.threads
+                        if thread.is_alive()]
+        while len(self.threads) < self.workers:
+            thread = Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            # Exit once there's nothing left to do, rather than holding on
+            # to an idle thread; submit() starts a new one when needed. The
+            # lock makes sure a keypair submitted in the meantime is seen.
+            with self.lock:
+                try:
+                    app, filesystem_id, codename = self.queue.get_nowait()
+                except Queue.Empty:
+                    self.threads.remove(current_thread())
+                    return
+            try:
+                with app.app_context():
+                    genkey(filesystem_id, codename)
+            except Exception as e:
+                app.logger.error(
+                    "genkey for source (filesystem_id={}): {}".format(
+                        filesystem_id, e))
+            finally:
+                with self.lock:
+                    self.pending.discard(filesystem_id)
+                self.queue.task_done()
+
+
+# gpg2 gains nothing from generating several keys at once on the same
+# keyring, so by default keypairs are generated one at a time
+keygen_pool = KeyGenerationPool(
+    workers=getattr(config, 'KEYGEN_WORKERS', 1),
+    max_queued=getattr(config, 'KEYGEN_QUEUE_SIZE', 100))
 
 
-@async
 def async_genkey(filesystem_id, codename):
-    crypto_util.genkeypair(filesystem_id, codename)
+    """Generate the reply keypair of a source in the background, on
+    :data:`keygen_pool`. Return False if it couldn't be queued."""
+    queued = keygen_pool.submit(current_app._get_current_object(),
+                                filesystem_id, codename)
+    if queued:
+        current_app.logger.info(
+            "key generation queue depth: {}".format(keygen_pool.depth()))
+    else:
+        current_app.logger.warning(
+            "key generation queue is full, not generating a key for source "
+            "(filesystem_id={})".format(filesystem_id))
+    return queued
+
+
+def genkey(filesystem_id, codename):
+    # The keypair may have been generated by another process since the
+    # request was queued
+    fingerprint = crypto_util.getkey(filesystem_id)
+    if fingerprint is None and crypto_util.KEYPOOL_SIZE:
+        fingerprint = crypto_util.take_pooled_keypair(filesystem_id, codename)
+        # Refill the pool in batches rather than after every keypair taken
+        if (len(crypto_util.pooled_keypairs()) <=
+                crypto_util.KEYPOOL_LOW_WATER):
+            worker.enqueue(crypto_util.fill_keypool)
+    if fingerprint is None:
+        fingerprint = crypto_util.genkeypair(filesystem_id,
+                                             codename).fingerprint
 
     # Register key generation as update to the source, so sources will
     # filter to the top of the list in the journalist interface if a
@@ -75,11 +277,12 @@ def async_genkey(filesystem_id, codename):
     try:
         source = Source.query.filter(Source.filesystem_id == filesystem_id) \
                        .one()
+        source.fingerprint = fingerprint
         source.last_updated = datetime.utcnow()
         db_session.commit()
     except Exception as e:
         current_app.logger.error(
-                "async_genkey for source (filesystem_id={}): {}"
+                "genkey for source (filesystem_id={}): {}"
                 .format(filesystem_id, e))
 
 
@@ -88,15 +291,23 @@ def normalize_timestamps(filesystem_id):
     Update the timestamps on all of the source's submissions to match that of
     the latest submission. This minimizes metadata that could be useful to
     investigators. See #301.
+
+    If the source has more than ``config.ASYNC_NORMALIZE_TIMESTAMPS_THRESHOLD``
+    submissions, it is left to the worker rather than done in the request.
     """
-    sub_paths = [store.path(filesystem_id, submission.filename)
-                 for submission in g.source.submissions]
-    if len(sub_paths) > 1:
-        args = ["touch"]
-        args.extend(sub_paths[:-1])
-        rc = subprocess.call(args)
-        if rc != 0:
-            current_app.logger.warning(
-                "Couldn't normalize submission "
-                "timestamps (touch exited with %d)" %
-                rc)
+    # Only the filenames are needed, not the submissions themselves
+    filenames = [filename for filename, in
+                 db_session.query(Submission.filename)
+                 .filter(Submission.source_id == g.source.id)
+                 .order_by(Submission.id)]
+    if len(filenames) < 2:
+        return
+    threshold = getattr(config, 'ASYNC_NORMALIZE_TIMESTAMPS_THRESHOLD', None)
+    if threshold is not None and len(filenames) > threshold:
+        worker.enqueue(store.normalize_timestamps, filesystem_id, filenames)
+        return
+    try:
+        store.normalize_timestamps(filesystem_id, filenames)
+    except OSError as e:
+        current_app.logger.warning(
+            "Couldn't normalize submission timestamps ({})".format(e))
@@ -44,11 +44,11 @@ $(function () {
   unread.css('cursor', 'pointer');
 
   all.click(function() {
-    var checkboxes = $(".panel :checkbox").filter(":visible");
+    var checkboxes = $(".panel ul :checkbox").filter(":visible");
     checkboxes.prop('checked', true);
   });
   none.click(function() {
-    var checkboxes = $(".panel :checkbox").filter(":visible");
+    var checkboxes = $(".panel ul :checkbox").filter(":visible");
     checkboxes.prop('checked', false);
   });
   unread.click(function() {
@@ -66,6 +66,10 @@ $(function () {
   });
 
   $("#delete-collections").click(function () {
+    if ($("#select-all-matching").prop('checked')) {
+      // The server asks for confirmation with the number of sources
+      return true;
+    }
     var checked = $(".panel ul#cols li :checkbox").filter(":visible").filter(function(index) {
         return $(this).prop('checked');
     });
@@ -108,6 +112,23 @@ $(function () {
     filter_codenames($('#filter').val())
   }
 
+  // Follow the progress of a bulk download, and reload the page to show
+  // the link to the archive once it is ready
+  var progress = $('#bulk-download-progress');
+  if (progress.length) {
+    var poll_bulk_download = function() {
+      $.getJSON(progress.attr('data-status-url'), function(job) {
+        progress.text(get_string("bulk-download-progress-string").supplant(job));
+        if (job.status == 'finished' || job.status == 'failed') {
+          window.location.reload();
+        } else {
+          setTimeout(poll_bulk_download, 2000);
+        }
+      });
+    };
+    setTimeout(poll_bulk_download, 2000);
+  }
+
   // Confirm before deleting user on admin page
   $('button.delete-user').click(function(event) {
       var username = $(this).attr('data-username');
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
+import errno
+import fcntl
+import hashlib
 import os
 import re
 import config
+import struct
+import time
 import zipfile
 import crypto_util
+import rm
 import tempfile
 import gzip
+from collections import OrderedDict
 from werkzeug import secure_filename
 
+import secure_tempfile
 from secure_tempfile import SecureTemporaryFile
 
 import logging
@@ -17,6 +25,9 @@ VALIDATE_FILENAME = re.compile(
     "^(?P<index>\d+)\-[a-z0-9-_]*"
     "(?P<file_type>msg|doc\.(gz|zip)|reply)\.gpg$").match
 
+# Base32 (and, in the tests, simpler) filesystem ids, so never '.' or '..'
+VALIDATE_FILESYSTEM_ID = re.compile("^[A-Za-z0-9=_-]+$").match
+
 
 class PathException(Exception):
 
@@ -43,7 +54,8 @@ def verify(p):
         raise PathException("The path is not absolute and/or normalized")
 
     # Check that the path p is in config.STORE_DIR
-    if os.path.relpath(p, config.STORE_DIR).startswith('..'):
+    store_dir = _store_dir()
+    if p != store_dir and not p.startswith(store_dir + os.sep):
         raise PathException("Invalid directory %s" % (p, ))
 
     if os.path.isfile(p):
@@ -60,44 +72,454 @@ def verify(p):
 
 def path(*s):
     """Get the normalized, absolute file path, within `config.STORE_DIR`."""
-    joined = os.path.join(os.path.abspath(config.STORE_DIR), *s)
+    if s and VALIDATE_FILESYSTEM_ID(s[0]):
+        joined = os.path.join(source_dir(s[0]), *s[1:])
+    else:
+        joined = os.path.join(_store_dir(), *s)
     absolute = os.path.abspath(joined)
     verify(absolute)
     return absolute
 
 
+def trusted_path(filesystem_id, filename=None):
+    """Get the absolute path of the directory of *filesystem_id*, or of
+    its file *filename*, within `config.STORE_DIR`.
+
+    Unlike :func:`path`, it doesn't touch the disk, and only checks the
+    format of *filesystem_id* and *filename*, so it is only meant for
+    values that don't come from the user, e.g. the filenames of
+    submissions and replies in the database.
+    """
+    if not VALIDATE_FILESYSTEM_ID(filesystem_id):
+        raise PathException("Invalid filesystem id %s" % (filesystem_id, ))
+    if filename is None:
+        return source_dir(filesystem_id)
+    if not VALIDATE_FILENAME(filename):
+        raise PathException("Invalid filename %s" % (filename, ))
+    return os.path.join(source_dir(filesystem_id), filename)
+
+
+def source_dir(filesystem_id):
+    """Return the absolute path of the directory of *filesystem_id*, in
+    the layout of `config.STORE_LAYOUT`:
+
+    - ``'flat'`` (the default): ``STORE_DIR/<filesystem_id>``
+    - ``'sharded'``: ``STORE_DIR/ab/cd/<filesystem_id>``, where ``abcd``
+      are the first hex digits of the SHA-256 of the filesystem id, so
+      that no directory of the store gets too large
+    - ``'migrating'``, from flat to sharded with ``manage.py
+      shard-store``: the sharded directory, unless only the flat one
+      exists. Unlike the others, it has to look at the disk.
+    """
+    layout = getattr(config, 'STORE_LAYOUT', 'flat')
+    flat = os.path.join(_store_dir(), filesystem_id)
+    if layout == 'flat':
+        return flat
+    sharded = os.path.join(_store_dir(), shard(filesystem_id))
+    if (layout == 'migrating' and not os.path.isdir(sharded) and
+            os.path.isdir(flat)):
+        return flat
+    return sharded
+
+
+def shard(filesystem_id):
+    """Return the path, relative to `config.STORE_DIR`, of the directory
+    of *filesystem_id* in the sharded layout."""
+    digest = hashlib.sha256(filesystem_id).hexdigest()
+    return os.path.join(digest[:2], digest[2:4], filesystem_id)
+
+
+def is_shard(name):
+    """Return whether the entry *name* of `config.STORE_DIR` is a shard of
+    the sharded layout, rather than the directory of a source."""
+    return len(name) == 2 and all(c in '0123456789abcdef' for c in name)
+
+
+def move_to_shard(filesystem_id):
+    """Move the directory of *filesystem_id* from the flat layout to the
+    sharded one."""
+    flat = os.path.join(_store_dir(), filesystem_id)
+    sharded = os.path.join(_store_dir(), shard(filesystem_id))
+    try:
+        os.makedirs(os.path.dirname(sharded))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd = os.open(flat, os.O_RDONLY)
+    try:
+        # Wait for those using the directory to be done with it
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # Atomic, so the directory is always found in one place or the other
+        os.rename(flat, sharded)
+    finally:
+        os.close(fd)
+
+
+class SourceLock(object):
+    """Keep the directory of *filesystem_id* where it is, in between
+    :meth:`acquire`, which returns its path, and :meth:`release`, or
+    within a ``with`` block.
+
+    A path resolved with :func:`source_dir` while the store is migrating
+    to the sharded layout stops being valid once :func:`move_to_shard` has
+    moved the directory. So anything that creates, renames or removes the
+    files of a source holds a (shared) lock on its directory, which
+    :func:`move_to_shard` waits for. Outside of a migration, directories
+    never move, and there's nothing to lock.
+    """
+
+    def __init__(self, filesystem_id):
+        self.filesystem_id = filesystem_id
+        self.fd = None
+
+    def acquire(self):
+        if getattr(config, 'STORE_LAYOUT', 'flat') != 'migrating':
+            return source_dir(self.filesystem_id)
+        while True:
+            directory = source_dir(self.filesystem_id)
+            try:
+                self.fd = os.open(directory, os.O_RDONLY)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                if source_dir(self.filesystem_id) == directory:
+                    # There's no directory to move (yet)
+                    return directory
+                continue
+            fcntl.flock(self.fd, fcntl.LOCK_SH)
+            # It may have been moved before it was locked
+            if source_dir(self.filesystem_id) == directory:
+                return directory
+            self.release()
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+_store_dirs = {}
+
+
+def _store_dir():
+    """Return the normalized, absolute `config.STORE_DIR`."""
+    try:
+        return _store_dirs[config.STORE_DIR]
+    except KeyError:
+        store_dir = _store_dirs[config.STORE_DIR] = os.path.abspath(
+            config.STORE_DIR)
+        return store_dir
+
+
+def normalize_timestamps(filesystem_id, filenames):
+    """Set the access and modification times of the source's submissions
+    *filenames* to those of the last one, so they don't reveal when each
+    of them was submitted. See #301.
+
+    The filenames are those of the database, so their paths are only
+    checked with :func:`trusted_path`, which keeps it cheap for sources with
+    many submissions.
+    """
+    with SourceLock(filesystem_id):
+        paths = [trusted_path(filesystem_id, filename)
+                 for filename in filenames]
+        latest = os.stat(paths[-1])
+        times = (latest.st_atime, latest.st_mtime)
+        for submission_path in paths[:-1]:
+            os.utime(submission_path, times)
+    return "success"
+
+
+def secure_delete(filesystem_id, filenames=None, progress=None):
+    """Securely delete the source's files *filenames*, or its whole
+    directory if None, with :func:`rm.srm_many`.
+
+    Meant to be queued for the worker rather than :func:`rm.srm_many`
+    itself, since the paths are only resolved when it runs: the directory
+    may have been moved to its shard since it was queued.
+    """
+    with SourceLock(filesystem_id) as directory:
+        if filenames is None:
+            paths = [directory]
+        else:
+            paths = [trusted_path(filesystem_id, filename)
+                     for filename in filenames]
+        return rm.srm_many(paths, progress=progress)
+
+
+# Size of the reads made when streaming submissions into a zip archive
+ZIP_STREAM_CHUNK_SIZE = 1024 * 64
+
+
+def bulk_archive_entries(selected_submissions, zip_directory=''):
+    """Return the ``(path, arcname)`` of each of the selected submissions
+    in a bulk download archive."""
+    # Group the submissions by source in a single pass, to create a more
+    # usable folder structure per #383
+    sources = OrderedDict()
+    for submission in selected_submissions:
+        source = submission.source
+        sources.setdefault(source.journalist_designation,
+                           []).append((source, submission))
+
+    entries = []
+    for designation, submissions in sources.items():
+        for source, submission in submissions:
+            filename = trusted_path(source.filesystem_id, submission.filename)
+            document_number = submission.filename.split('-')[0]
+            if zip_directory == source.journalist_filename:
+                fname = zip_directory
+            else:
+                fname = os.path.join(zip_directory, designation)
+            entries.append((filename, os.path.join(
+                fname,
+                "%s_%s" % (document_number, source.last_updated.date()),
+                os.path.basename(filename)
+            )))
+    return entries
+
+
 def get_bulk_archive(selected_submissions, zip_directory=''):
     """Generate a zip file from the selected submissions"""
     zip_file = tempfile.NamedTemporaryFile(prefix='tmp_securedrop_bulk_dl_',
                                            dir=config.TEMP_DIR,
                                            delete=False)
-    sources = set([i.source.journalist_designation
-                   for i in selected_submissions])
-    # The below nested for-loops are there to create a more usable
-    # folder structure per #383
-    with zipfile.ZipFile(zip_file, 'w') as zip:
-        for source in sources:
-            fname = ""
-            submissions = [s for s in selected_submissions
-                           if s.source.journalist_designation == source]
-            for submission in submissions:
-                filename = path(submission.source.filesystem_id,
-                                submission.filename)
-                verify(filename)
-                document_number = submission.filename.split('-')[0]
-                if zip_directory == submission.source.journalist_filename:
-                    fname = zip_directory
-                else:
-                    fname = os.path.join(zip_directory, source)
-                zip.write(filename, arcname=os.path.join(
-                    fname,
-                    "%s_%s" % (document_number,
-                               submission.source.last_updated.date()),
-                    os.path.basename(filename)
-                ))
+    with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as zip:
+        for filename, arcname in bulk_archive_entries(selected_submissions,
+                                                      zip_directory):
+            zip.write(filename, arcname=arcname)
     return zip_file
 
 
+# Bulk download jobs are identified by a UUID, which is also used to name
+# the archive they build
+VALIDATE_BULK_ARCHIVE_JOB_ID = re.compile(
+    "^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$").match
+
+
+def bulk_archive_path(job_id):
+    """Get the path, in `config.TEMP_DIR`, of the archive built by the bulk
+    download job *job_id*."""
+    if not VALIDATE_BULK_ARCHIVE_JOB_ID(job_id):
+        raise PathException("Invalid bulk download job id %s" % (job_id, ))
+    return os.path.join(config.TEMP_DIR,
+                        'securedrop_bulk_dl_{}.zip'.format(job_id))
+
+
+def write_bulk_archive(entries, archive_path, progress=None):
+    """Write a zip file of *entries*, as returned by
+    :func:`bulk_archive_entries`, to *archive_path*.
+
+    This is meant to run in the worker: it doesn't need a database
+    session, and *progress*, if given, is called with the number of
+    entries written so far and the total number of entries. The archive is
+    written to a temporary file that is only renamed to *archive_path*
+    once complete, so a partial archive is never served.
+    """
+    zip_file = tempfile.NamedTemporaryFile(prefix='tmp_securedrop_bulk_dl_',
+                                           dir=os.path.dirname(archive_path),
+                                           delete=False)
+    try:
+        with zipfile.ZipFile(zip_file, 'w', allowZip64=True) as zip:
+            for count, (filename, arcname) in enumerate(entries, 1):
+                zip.write(filename, arcname=arcname)
+                if progress:
+                    progress(count, len(entries))
+        zip_file.close()
+        os.rename(zip_file.name, archive_path)
+    except Exception:
+        zip_file.close()
+        os.remove(zip_file.name)
+        raise
+    return archive_path
+
+
+def stream_bulk_archive(selected_submissions, zip_directory=''):
+    """Return an iterator over the contents of a zip file of the selected
+    submissions, generated as it is consumed, so it can be sent to the
+    client without first being written to disk.
+
+    The paths and names of the submissions are resolved before this
+    function returns, so the iterator doesn't need a database session.
+    """
+    return _stream_zip(bulk_archive_entries(selected_submissions,
+                                            zip_directory))
+
+
+def _stream_zip(entries):
+    """Yield a zip archive of *entries*, a list of ``(path, arcname)``
+    tuples, a chunk at a time.
+
+    The files are stored without compression, since encrypted submissions
+    don't compress, and the CRC of each one is written in a data
+    descriptor after its contents so the archive never has to be seeked
+    back into. ZIP64 extensions are used when sizes or offsets require
+    them, like :class:`zipfile.ZipFile` does.
+    """
+    offset = 0
+    infos = []
+    for filename, arcname in entries:
+        st = os.stat(filename)
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.flag_bits = 0x08  # sizes and CRC follow the data
+        zinfo.header_offset = offset
+        zip64 = st.st_size > zipfile.ZIP64_LIMIT
+        if zip64:
+            zinfo.extract_version = max(45, zinfo.extract_version)
+            zinfo.create_version = max(45, zinfo.create_version)
+
+        header = zinfo.FileHeader(zip64)
+        yield header
+        offset += len(header)
+
+        crc = 0
+        size = 0
+        with open(filename, 'rb') as f:
+            while True:
+                buf = f.read(ZIP_STREAM_CHUNK_SIZE)
+                if not buf:
+                    break
+                crc = zipfile.crc32(buf, crc)
+                size += len(buf)
+                yield buf
+        zinfo.CRC = crc & 0xFFFFFFFF
+        zinfo.file_size = zinfo.compress_size = size
+        offset += size
+
+        descriptor = struct.pack('<LLQQ' if zip64 else '<LLLL',
+                                 0x08074b50, zinfo.CRC, size, size)
+        yield descriptor
+        offset += len(descriptor)
+        infos.append(zinfo)
+
+    central_directory_offset = offset
+    for zinfo in infos:
+        record = _central_directory_record(zinfo)
+        yield record
+        offset += len(record)
+    yield _end_of_central_directory(len(infos),
+                                    offset - central_directory_offset,
+                                    central_directory_offset)
+
+
+def _central_directory_record(zinfo):
+    """Return the central directory record of *zinfo*, as written by
+    :meth:`zipfile.ZipFile.close`."""
+    dt = zinfo.date_time
+    dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
+    dostime = dt[3] << 11 | dt[4] << 5 | (dt[5] // 2)
+    extra = []
+    if zinfo.file_size > zipfile.ZIP64_LIMIT:
+        extra.extend([zinfo.file_size, zinfo.compress_size])
+        file_size = compress_size = 0xFFFFFFFF
+    else:
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+    if zinfo.header_offset > zipfile.ZIP64_LIMIT:
+        extra.append(zinfo.header_offset)
+        header_offset = 0xFFFFFFFF
+    else:
+        header_offset = zinfo.header_offset
+
+    extra_data = zinfo.extra
+    extract_version = zinfo.extract_version
+    create_version = zinfo.create_version
+    if extra:
+        extra_data = struct.pack('<HH' + 'Q' * len(extra),
+                                 1, 8 * len(extra), *extra) + extra_data
+        extract_version = max(45, extract_version)
+        create_version = max(45, create_version)
+
+    filename, flag_bits = zinfo._encodeFilenameFlags()
+    return struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir,
+                       create_version, zinfo.create_system, extract_version,
+                       zinfo.reserved, flag_bits, zinfo.compress_type,
+                       dostime, dosdate, zinfo.CRC, compress_size, file_size,
+                       len(filename), len(extra_data), len(zinfo.comment), 0,
+                       zinfo.internal_attr, zinfo.external_attr,
+                       header_offset) + filename + extra_data + zinfo.comment
+
+
+def _end_of_central_directory(count, size, offset):
+    """Return the end of central directory record(s) of an archive with
+    *count* entries whose central directory of *size* bytes starts at
+    *offset*."""
+    records = ''
+    if (count > zipfile.ZIP_FILECOUNT_LIMIT or
+            offset > zipfile.ZIP64_LIMIT or size > zipfile.ZIP64_LIMIT):
+        records += struct.pack(zipfile.structEndArchive64,
+                               zipfile.stringEndArchive64,
+                               44, 45, 45, 0, 0, count, count, size, offset)
+        records += struct.pack(zipfile.structEndArchive64Locator,
+                               zipfile.stringEndArchive64Locator,
+                               0, offset + size, 1)
+        count = min(count, 0xFFFF)
+        size = min(size, 0xFFFFFFFF)
+        offset = min(offset, 0xFFFFFFFF)
+    return records + struct.pack(zipfile.structEndArchive,
+                                 zipfile.stringEndArchive,
+                                 0, 0, count, count, size, offset, 0)
+
+
+class EncryptedUpload(object):
+    """A file submission that is gzipped and encrypted to the journalist key
+    as it is uploaded, by the gpg2 process it is piped into.
+
+    Unlike an upload buffered in a :class:`SecureTemporaryFile`, it never
+    touches the disk before it is encrypted to the journalist key, and
+    there's nothing left to do once it is uploaded. Its name isn't known
+    until the submission is saved, so it is encrypted to a temporary file
+    in the source's directory, which :func:`save_file_submission` renames.
+    If it isn't saved, closing the upload removes it. Either way, the
+    directory is kept from moving (see :class:`SourceLock`) until then.
+    """
+
+    def __init__(self, filesystem_id, filename):
+        self.saved = False
+        self.lock = SourceLock(filesystem_id)
+        self.tmp_path = os.path.join(
+            self.lock.acquire(),
+            '.upload-{}.gpg'.format(os.urandom(16).encode('hex')))
+        try:
+            self.encrypted = crypto_util.encrypting_file(
+                config.JOURNALIST_KEY, self.tmp_path)
+        except Exception:
+            self.lock.release()
+            raise
+        self.gzf = gzip.GzipFile(filename=secure_filename(filename),
+                                 mode='wb', fileobj=self.encrypted)
+
+    def write(self, data):
+        self.gzf.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # werkzeug rewinds the upload once it's complete, which doesn't
+        # matter here
+        pass
+
+    def save(self, encrypted_file_path):
+        self.gzf.close()
+        self.encrypted.close()
+        os.rename(self.tmp_path, encrypted_file_path)
+        self.saved = True
+        self.lock.release()
+
+    def close(self):
+        try:
+            if not self.saved:
+                self.encrypted.discard()
+        finally:
+            self.lock.release()
+
+
 def save_file_submission(filesystem_id, count, journalist_filename, filename,
                          stream):
     sanitized_filename = secure_filename(filename)
@@ -118,19 +540,25 @@ def save_file_submission(filesystem_id, count, journalist_filename, filename,
     encrypted_file_name = "{0}-{1}-doc.gz.gpg".format(
         count,
         journalist_filename)
-    encrypted_file_path = path(filesystem_id, encrypted_file_name)
-    with SecureTemporaryFile("/tmp") as stf:
-        with gzip.GzipFile(filename=sanitized_filename,
-                           mode='wb', fileobj=stf) as gzf:
-            # Buffer the stream into the gzip file to avoid excessive
-            # memory consumption
-            while True:
-                buf = stream.read(1024 * 8)
-                if not buf:
-                    break
-                gzf.write(buf)
+    with SourceLock(filesystem_id):
+        encrypted_file_path = path(filesystem_id, encrypted_file_name)
+        if isinstance(stream, EncryptedUpload):
+            stream.save(encrypted_file_path)
+            return encrypted_file_name
+
+        with SecureTemporaryFile("/tmp") as stf:
+            with gzip.GzipFile(filename=sanitized_filename,
+                               mode='wb', fileobj=stf) as gzf:
+                # Buffer the stream into the gzip file to avoid excessive
+                # memory consumption
+                while True:
+                    buf = stream.read(secure_tempfile.CHUNK_SIZE)
+                    if not buf:
+                        break
+                    gzf.write(buf)
 
-        crypto_util.encrypt(stf, config.JOURNALIST_KEY, encrypted_file_path)
+            crypto_util.encrypt(stf, config.JOURNALIST_KEY,
+                                encrypted_file_path)
 
     return encrypted_file_name
 
@@ -138,8 +566,9 @@ def save_file_submission(filesystem_id, count, journalist_filename, filename,
 def save_message_submission(filesystem_id, count, journalist_filename,
                             message):
     filename = "{0}-{1}-msg.gpg".format(count, journalist_filename)
-    msg_loc = path(filesystem_id, filename)
-    crypto_util.encrypt(message, config.JOURNALIST_KEY, msg_loc)
+    with SourceLock(filesystem_id):
+        msg_loc = path(filesystem_id, filename)
+        crypto_util.encrypt(message, config.JOURNALIST_KEY, msg_loc)
     return filename
 
 
@@ -152,8 +581,9 @@ def rename_submission(filesystem_id, orig_filename, journalist_filename):
                 parsed_filename['index'], journalist_filename,
                 parsed_filename['file_type'])
             try:
-                os.rename(path(filesystem_id, orig_filename),
-                          path(filesystem_id, new_filename))
+                with SourceLock(filesystem_id):
+                    os.rename(path(filesystem_id, orig_filename),
+                              path(filesystem_id, new_filename))
             except OSError:
                 pass
             else:
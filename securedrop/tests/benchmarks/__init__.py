@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for hot paths of the web applications.
+
+They aren't collected by pytest, and are run from the securedrop directory
+as modules, e.g. ``python -m tests.benchmarks.bench_crypto``. Like the
+tests, they run against the test environment in ``/tmp/securedrop``.
+"""
+from os.path import abspath, dirname, join, realpath
+import sys
+import time
+
+# Make the test utilities importable as `utils`, as they are in the tests.
+sys.path.insert(0, abspath(join(dirname(realpath(__file__)), '..')))
+
+
+def timed(func, iterations):
+    """Call *func* *iterations* times and return the mean duration of a call,
+    in milliseconds.
+    """
+    start = time.time()
+    for _ in range(iterations):
+        func()
+    return (time.time() - start) * 1000 / iterations
+
+
+def report(name, ms):
+    print('{:<40} {:>10.2f} ms'.format(name, ms))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Compare the cost of encrypting and decrypting messages and replies with
+each of the available crypto_util backends.
+"""
+import argparse
+import os
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from tests.benchmarks import report, timed
+import config
+import crypto_util
+import utils
+
+MESSAGE = 'A message of a typical length. ' * 32
+
+
+def bench_backend(backend, source_fingerprint, passphrase, iterations):
+    recipients = [config.JOURNALIST_KEY]
+    report('{}: encrypt message'.format(backend.name),
+           timed(lambda: backend.encrypt(MESSAGE, recipients), iterations))
+
+    recipients = [config.JOURNALIST_KEY, source_fingerprint]
+    report('{}: encrypt reply'.format(backend.name),
+           timed(lambda: backend.encrypt(MESSAGE, recipients), iterations))
+
+    ciphertext = backend.encrypt(MESSAGE, [source_fingerprint])
+    report('{}: decrypt reply'.format(backend.name),
+           timed(lambda: backend.decrypt(passphrase, ciphertext,
+                                         source_fingerprint),
+                 iterations))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('backends', nargs='*',
+                        default=sorted(crypto_util.BACKENDS))
+    args = parser.parse_args()
+
+    utils.env.setup()
+    try:
+        source, codename = utils.db_helper.init_source()
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        passphrase = crypto_util.hash_codename(
+            codename, salt=crypto_util.SCRYPT_GPG_PEPPER)
+        for name in args.backends:
+            try:
+                backend = crypto_util.BACKENDS[name](crypto_util.gpg)
+            except crypto_util.CryptoException as e:
+                print('{}: skipped ({})'.format(name, e))
+                continue
+            bench_backend(backend, fingerprint, passphrase, args.iterations)
+    finally:
+        utils.env.teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""Microbenchmarks of the validation of paths in the store."""
+import argparse
+import os
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from tests.benchmarks import report, timed
+import store
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=100000)
+    args = parser.parse_args()
+
+    utils.env.setup()
+    try:
+        filesystem_id = 'bench'
+        filename = '1-bench-msg.gpg'
+        os.makedirs(store.path(filesystem_id))
+        open(store.path(filesystem_id, filename), 'w').close()
+        absolute = store.path(filesystem_id, filename)
+
+        for name, func in (
+                ('store.path (directory)',
+                 lambda: store.path(filesystem_id)),
+                ('store.path (file)',
+                 lambda: store.path(filesystem_id, filename)),
+                ('store.verify (file)',
+                 lambda: store.verify(absolute)),
+                ('store.trusted_path (directory)',
+                 lambda: store.trusted_path(filesystem_id)),
+                ('store.trusted_path (file)',
+                 lambda: store.trusted_path(filesystem_id, filename))):
+            report(name + ' x1000', timed(func, args.iterations) * 1000)
+    finally:
+        utils.env.teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Measure the write and read throughput of SecureTemporaryFile with each of
+the AES-CTR implementations available.
+"""
+import argparse
+import os
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from tests.benchmarks import timed
+import secure_tempfile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help='size of the file, in MB')
+    parser.add_argument('-c', '--chunk-size', type=int,
+                        default=secure_tempfile.CHUNK_SIZE)
+    args = parser.parse_args()
+    chunk = os.urandom(args.chunk_size)
+    chunks = args.size * 1024 * 1024 // args.chunk_size
+    mb = float(chunks * args.chunk_size) / 1024 / 1024
+
+    ciphers = [secure_tempfile.PyCryptoCTR, secure_tempfile.OpenSSLCTR]
+    print('default: {}'.format(secure_tempfile.AES_CTR.name))
+
+    for cipher in ciphers:
+        secure_tempfile.AES_CTR = cipher
+        stf = secure_tempfile.SecureTemporaryFile('/tmp', args.chunk_size)
+
+        def write():
+            for _ in range(chunks):
+                stf.write(chunk)
+            stf.flush()
+
+        def read():
+            while stf.read(args.chunk_size):
+                pass
+
+        try:
+            for name, func in (('write', write), ('read', read)):
+                print('{:<20} {:>8.1f} MB/s'.format(
+                    '{} {}'.format(cipher.name, name),
+                    mb / timed(func, 1) * 1000))
+        finally:
+            stf.close()
+
+
+if __name__ == '__main__':
+    main()
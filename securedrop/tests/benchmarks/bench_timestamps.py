@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Compare normalizing the timestamps of the submissions of a source with
+many submissions by running `touch`, as was done before, with
+store.normalize_timestamps.
+"""
+import argparse
+import os
+import subprocess
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from tests.benchmarks import report, timed
+import store
+import utils
+
+
+def touch(filesystem_id, filenames):
+    paths = [store.path(filesystem_id, filename) for filename in filenames]
+    subprocess.check_call(['touch'] + paths[:-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--iterations', type=int, default=20)
+    parser.add_argument('-s', '--submissions', type=int, default=1000)
+    args = parser.parse_args()
+
+    utils.env.setup()
+    try:
+        filesystem_id = 'bench'
+        os.makedirs(store.path(filesystem_id))
+        filenames = ['{}-bench-msg.gpg'.format(i)
+                     for i in range(1, args.submissions + 1)]
+        for filename in filenames:
+            open(store.path(filesystem_id, filename), 'w').close()
+
+        report('touch', timed(lambda: touch(filesystem_id, filenames),
+                              args.iterations))
+        report('store.normalize_timestamps',
+               timed(lambda: store.normalize_timestamps(filesystem_id,
+                                                        filenames),
+                     args.iterations))
+    finally:
+        utils.env.teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Measure the throughput, in MB/s, of each stage a file submission goes
+through, with a given chunk size.
+"""
+import argparse
+from cStringIO import StringIO
+import gzip
+import os
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+from werkzeug import formparser
+from werkzeug.test import encode_multipart
+
+from tests.benchmarks import timed
+import config
+import crypto_util
+import secure_tempfile
+from secure_tempfile import SecureTemporaryFile
+import utils
+
+
+def report(name, mb, ms):
+    print('{:<50} {:>8.1f} MB/s'.format(name, mb / ms * 1000))
+
+
+class NullFile(object):
+
+    def write(self, data):
+        pass
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        pass
+
+
+def bench_parse(parser_class, body, boundary):
+    def parse():
+        parser = parser_class(lambda *args, **kwargs: NullFile())
+        parser.parse(StringIO(body), 'multipart/form-data', len(body),
+                     {'boundary': boundary})
+    return timed(parse, 1)
+
+
+def write_stf(data, chunk_size):
+    stf = SecureTemporaryFile('/tmp', chunk_size=chunk_size)
+    with gzip.GzipFile(filename='x', mode='wb', fileobj=stf) as gzf:
+        for i in range(0, len(data), chunk_size):
+            gzf.write(data[i:i + chunk_size])
+    return stf
+
+
+def read_stf(stf, count):
+    while stf.read(count):
+        pass
+    stf.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help='size of the submission, in MB')
+    parser.add_argument('-c', '--chunk-size', type=int,
+                        default=secure_tempfile.CHUNK_SIZE)
+    args = parser.parse_args()
+    secure_tempfile.CHUNK_SIZE = args.chunk_size
+    size = args.size * 1024 * 1024
+    mb = float(args.size)
+    # Half random, half compressible, like a typical document
+    data = os.urandom(size // 2) + '\0' * (size - size // 2)
+
+    boundary = '----bench'
+    body = encode_multipart({'fh': (StringIO(data), 'x')}, boundary)[1]
+    report('parse (werkzeug)', mb,
+           bench_parse(formparser.FormDataParser, body, boundary))
+    del body
+
+    ms = timed(lambda: write_stf(data, args.chunk_size).close(), 1)
+    report('gzip into SecureTemporaryFile', mb, ms)
+    for count in (1024, args.chunk_size):
+        stf = write_stf(data, args.chunk_size)
+        report('SecureTemporaryFile.read({})'.format(count), mb,
+               timed(lambda: read_stf(stf, count), 1))
+
+    utils.env.setup()
+    try:
+        output = os.path.join(config.STORE_DIR, '1-bench-doc.gz.gpg')
+
+        def encrypt_stream():
+            with crypto_util.encrypting_file(config.JOURNALIST_KEY,
+                                             output) as encrypted:
+                for i in range(0, len(data), args.chunk_size):
+                    encrypted.write(data[i:i + args.chunk_size])
+        report('gpg2 (EncryptingFile)', mb, timed(encrypt_stream, 1))
+
+        def encrypt_stf():
+            stf = write_stf(data, args.chunk_size)
+            crypto_util.encrypt(stf, config.JOURNALIST_KEY, output)
+            stf.close()
+        report('gzip, SecureTemporaryFile, gpg2 (python-gnupg)', mb,
+               timed(encrypt_stf, 1))
+    finally:
+        utils.env.teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import io
 import os
+import threading
 import unittest
 
+import mock
+
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 import config
 import crypto_util
@@ -113,6 +117,27 @@ class TestCryptoUtil(unittest.TestCase):
 
         self.assertEqual(message, plaintext)
 
+    def test_encrypting_file_failure(self):
+        source, _ = utils.db_helper.init_source()
+        output = store.path(source.filesystem_id, '1-x-doc.gz.gpg')
+        encrypted = crypto_util.encrypting_file('0' * 40, output)
+
+        with self.assertRaises(crypto_util.CryptoException):
+            # gpg2 may fail before all of it is written
+            encrypted.write(os.urandom(1024 * 1024))
+            encrypted.close()
+        self.assertFalse(os.path.exists(output))
+        self.assertTrue(encrypted.stderr.closed)
+
+    def test_encrypting_file_uses_the_backend(self):
+        source, _ = utils.db_helper.init_source()
+        output = store.path(source.filesystem_id, '1-x-doc.gz.gpg')
+
+        with mock.patch.object(crypto_util, 'backend') as backend:
+            crypto_util.encrypting_file(config.JOURNALIST_KEY, output)
+        backend.encrypting_file.assert_called_once_with(
+            [config.JOURNALIST_KEY], output)
+
     def test_basic_encrypt_then_decrypt_multiple_recipients(self):
         source, codename = utils.db_helper.init_source()
         message = str(os.urandom(1))
@@ -198,3 +223,198 @@ class TestCryptoUtil(unittest.TestCase):
         source, _ = utils.db_helper.init_source()
 
         self.assertIsNotNone(crypto_util.getkey(source.filesystem_id))
+
+    def test_getkey_does_not_list_keys_once_index_is_loaded(self):
+        source, _ = utils.db_helper.init_source()
+        crypto_util.getkey(source.filesystem_id)
+
+        with mock.patch.object(crypto_util.gpg, 'list_keys') as list_keys:
+            self.assertIsNotNone(crypto_util.getkey(source.filesystem_id))
+            self.assertIsNone(crypto_util.getkey('not a filesystem id'))
+        list_keys.assert_not_called()
+
+    def test_keyring_index_updated_by_genkeypair_and_delete(self):
+        crypto_util.getkey('load the index')
+        source, codename = utils.db_helper.init_source_without_keypair()
+        key = crypto_util.genkeypair(source.filesystem_id, codename)
+
+        with mock.patch.object(crypto_util.gpg, 'list_keys') as list_keys:
+            self.assertEqual(crypto_util.getkey(source.filesystem_id),
+                             key.fingerprint)
+            crypto_util.delete_reply_keypair(source.filesystem_id)
+            self.assertIsNone(crypto_util.getkey(source.filesystem_id))
+        list_keys.assert_not_called()
+
+    def test_keyring_index_reloaded_when_keyring_changes(self):
+        source, _ = utils.db_helper.init_source()
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        # Simulate another process (e.g. the other web application) having
+        # deleted the key behind our back.
+        crypto_util.gpg.delete_keys(fingerprint, True)
+        crypto_util.gpg.delete_keys(fingerprint)
+
+        self.assertIsNone(crypto_util.getkey(source.filesystem_id))
+
+    def test_keyring_index_reloaded_when_changed_concurrently(self):
+        source, _ = utils.db_helper.init_source()
+        crypto_util.getkey(source.filesystem_id)
+        # Another process changes the keyring before we make and record our
+        # own change, which must not hide theirs.
+        for keyring, mtime, _ in crypto_util._get_keyring_signature():
+            path = os.path.join(config.GPG_KEY_DIR, keyring)
+            os.utime(path, (mtime + 10, mtime + 10))
+        signature = crypto_util._get_keyring_signature()
+        crypto_util._update_keyring_index(signature, {'name': 'fingerprint'})
+
+        with mock.patch.object(crypto_util.gpg, 'list_keys',
+                               wraps=crypto_util.gpg.list_keys) as list_keys:
+            self.assertIsNone(crypto_util.getkey('name'))
+        list_keys.assert_called_once_with()
+
+    def test_scrypt_pool_records_stats(self):
+        pool = crypto_util.ScryptPool(workers=1, max_queued=0, timeout=0)
+
+        self.assertEqual(pool.hash('password', 'salt', N=2, r=1, p=1),
+                         crypto_util.scrypt.hash('password', 'salt',
+                                                 N=2, r=1, p=1))
+        stats = pool.stats()
+        self.assertEqual(stats['hashes'], 1)
+        self.assertEqual(stats['rejected'], 0)
+        self.assertEqual((stats['running'], stats['waiting']), (0, 0))
+
+    def test_scrypt_pool_rejects_when_saturated(self):
+        pool = crypto_util.ScryptPool(workers=1, max_queued=0, timeout=1)
+        pool._acquire()
+
+        with self.assertRaises(crypto_util.ScryptBusyException):
+            pool.hash('password', 'salt', N=2, r=1, p=1)
+        self.assertEqual(pool.stats()['rejected'], 1)
+
+    def test_scrypt_pool_times_out(self):
+        pool = crypto_util.ScryptPool(workers=1, max_queued=1, timeout=0.01)
+        pool._acquire()
+
+        with self.assertRaises(crypto_util.ScryptBusyException):
+            pool.hash('password', 'salt', N=2, r=1, p=1)
+        self.assertEqual(pool.stats()['waiting'], 0)
+
+    def test_scrypt_pool_background_hashes_yield_to_requests(self):
+        pool = crypto_util.ScryptPool(workers=1, max_queued=1, timeout=5)
+        wait_time = pool._acquire()
+        order = []
+
+        def hash_in_thread(name, background):
+            pool.hash(name, 'salt', background=background)
+
+        # Recorded while the hash holds its slot, unlike once it returns
+        with mock.patch('scrypt.hash',
+                        side_effect=lambda password, salt: order.append(
+                            password)):
+            background = threading.Thread(target=hash_in_thread,
+                                          args=('background', True))
+            background.start()
+            # The background hash doesn't count against max_queued
+            request = threading.Thread(target=hash_in_thread,
+                                       args=('request', False))
+            request.start()
+            utils.async.wait_for_assertion(
+                lambda: self.assertEqual(pool.stats()['waiting'], 1))
+            pool._release(wait_time, 0)
+            background.join(5)
+            request.join(5)
+
+        self.assertEqual(order, ['request', 'background'])
+        self.assertEqual(pool.stats()['rejected'], 0)
+
+    @mock.patch('crypto_util.get_entropy_estimate', return_value=4096)
+    def test_take_pooled_keypair(self, get_entropy_estimate):
+        self.assertEqual(crypto_util.fill_keypool(1), 1)
+        # The pool is already full
+        self.assertEqual(crypto_util.fill_keypool(1), 0)
+        pooled_name, = crypto_util.pooled_keypairs()
+        secret_path = crypto_util._keypool_secret_path(pooled_name)
+        self.assertEqual(os.stat(secret_path).st_mode & 0o777, 0o600)
+        source, codename = utils.db_helper.init_source_without_keypair()
+
+        fingerprint = crypto_util.take_pooled_keypair(source.filesystem_id,
+                                                      codename)
+
+        self.assertEqual(crypto_util.getkey(source.filesystem_id),
+                         fingerprint)
+        self.assertEqual(crypto_util.pooled_keypairs(), [])
+        # The secret the pooled passphrase was derived from is gone
+        self.assertFalse(os.path.exists(secret_path))
+        # The keypair is now protected by the source's passphrase
+        message = 'Hello, source!'
+        ciphertext = crypto_util.encrypt(message, fingerprint)
+        self.assertEqual(crypto_util.decrypt(codename, ciphertext), message)
+        # and only has their UID, the same genkeypair gives
+        key = [k for k in crypto_util.gpg.list_keys()
+               if k['fingerprint'] == fingerprint][0]
+        self.assertEqual(key['uids'], ['Autogenerated Key <{}>'.format(
+            source.filesystem_id)])
+
+    def test_take_pooled_keypair_from_empty_pool(self):
+        source, codename = utils.db_helper.init_source_without_keypair()
+        self.assertIsNone(crypto_util.take_pooled_keypair(
+            source.filesystem_id, codename))
+
+    @mock.patch('crypto_util.get_entropy_estimate', return_value=300)
+    def test_fill_keypool_with_low_entropy(self, get_entropy_estimate):
+        self.assertEqual(crypto_util.fill_keypool(1), 0)
+        self.assertEqual(crypto_util.pooled_keypairs(), [])
+
+    def test_pgpy_backend_interoperates_with_gpg(self):
+        backend = crypto_util.PGPyBackend(crypto_util.gpg)
+        source, codename = utils.db_helper.init_source()
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        passphrase = crypto_util.hash_codename(
+            codename, salt=crypto_util.SCRYPT_GPG_PEPPER)
+        message = 'Hello, source!'
+
+        ciphertext = backend.encrypt(message, [fingerprint])
+        self.assertEqual(backend.decrypt(passphrase, ciphertext, fingerprint),
+                         message)
+        self.assertEqual(backend.decrypt('wrong passphrase', ciphertext,
+                                         fingerprint), '')
+        self.assertEqual(crypto_util.GPGBackend(crypto_util.gpg).decrypt(
+            passphrase, ciphertext), message)
+
+    def test_decrypt_many(self):
+        source, codename = utils.db_helper.init_source()
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        messages = ['Hello, source!', 'Goodbye, source!']
+        ciphertexts = [crypto_util.encrypt(message, fingerprint)
+                       for message in messages]
+
+        with mock.patch('crypto_util.hash_codename',
+                        wraps=crypto_util.hash_codename) as hash_codename:
+            self.assertEqual(crypto_util.decrypt_many(
+                codename, ciphertexts + ['garbage'], fingerprint),
+                messages + [''])
+        self.assertEqual(hash_codename.call_count, 1)
+
+    def test_pgpy_backend_decrypts_many_with_one_unlock(self):
+        backend = crypto_util.PGPyBackend(crypto_util.gpg)
+        source, codename = utils.db_helper.init_source()
+        passphrase = crypto_util.hash_codename(
+            codename, salt=crypto_util.SCRYPT_GPG_PEPPER)
+        fingerprint = crypto_util.getkey(source.filesystem_id)
+        messages = ['Hello, source!', 'Goodbye, source!']
+        ciphertexts = [backend.encrypt(message, [fingerprint])
+                       for message in messages]
+
+        unlock = crypto_util.pgpy.PGPKey.unlock
+        with mock.patch.object(crypto_util.pgpy.PGPKey, 'unlock',
+                               autospec=True, side_effect=unlock) as mocked:
+            self.assertEqual(backend.decrypt_many(
+                passphrase, ciphertexts + ['garbage'], fingerprint),
+                messages + [''])
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_pgpy_backend_encrypts_streams_with_gpg(self):
+        backend = crypto_util.PGPyBackend(crypto_util.gpg)
+        stream = io.BytesIO('Hello, journalist!')
+        with mock.patch.object(crypto_util.GPGBackend, 'encrypt') as encrypt:
+            backend.encrypt(stream, [config.JOURNALIST_KEY])
+        encrypt.assert_called_once_with(stream, [config.JOURNALIST_KEY], None)
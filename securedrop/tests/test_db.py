@@ -4,8 +4,8 @@ import mock
 
 import journalist
 from utils import db_helper, env
-from db import (Journalist, Submission, Reply, get_one_or_else,
-                LoginThrottledException)
+from db import (Journalist, Submission, Reply, Source, get_one_or_else,
+                LoginThrottledException, _add_column_ddl)
 
 
 class TestDatabase(TestCase):
@@ -80,3 +80,20 @@ class TestDatabase(TestCase):
             Journalist.throttle_login(journalist)
         with self.assertRaises(LoginThrottledException):
             Journalist.throttle_login(journalist)
+
+    def test_add_column_ddl_renders_defaults(self):
+        table = Source.__table__
+        self.assertEqual(_add_column_ddl(table, table.c.flagged),
+                         'ALTER TABLE sources ADD COLUMN flagged BOOLEAN '
+                         'DEFAULT 0')
+        self.assertEqual(_add_column_ddl(table, table.c.unread_count),
+                         'ALTER TABLE sources ADD COLUMN unread_count '
+                         'INTEGER NOT NULL DEFAULT 0')
+        self.assertEqual(_add_column_ddl(table, table.c.fingerprint),
+                         'ALTER TABLE sources ADD COLUMN fingerprint '
+                         'VARCHAR(40)')
+
+    def test_add_column_ddl_refuses_callable_defaults(self):
+        table = Source.__table__
+        with self.assertRaises(ValueError):
+            _add_column_ddl(table, table.c.last_updated)
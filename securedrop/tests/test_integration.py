@@ -16,7 +16,7 @@ import gnupg
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 import config
 import crypto_util
-from db import db_session, Journalist
+from db import db_session, Journalist, Source
 import journalist
 import source
 import store
@@ -334,11 +334,13 @@ class TestIntegration(unittest.TestCase):
             self.assertTrue(g.source.flagged)
             source_app.get('/logout')
 
-        # Block up to 15s for the reply keypair, so we can test sending a reply
-        utils.async.wait_for_assertion(
-            lambda: self.assertNotEqual(crypto_util.getkey(filesystem_id),
-                                        None),
-            15)
+        # Block up to 15s for the reply keypair to be recorded, so we can
+        # test sending a reply
+        def assert_source_has_key():
+            db_session.expire_all()
+            self.assertIsNotNone(Source.query.filter_by(
+                filesystem_id=filesystem_id).one().fingerprint)
+        utils.async.wait_for_assertion(assert_source_has_key, 15)
 
         # Create 2 replies to test deleting on journalist and source interface
         for i in range(2):
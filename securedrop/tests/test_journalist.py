@@ -7,7 +7,8 @@ import zipfile
 
 from flask import url_for, escape, session
 from flask_testing import TestCase
-from mock import patch
+from mock import Mock, patch
+from sqlalchemy import inspect
 from sqlalchemy.orm.exc import StaleDataError
 from sqlalchemy.exc import IntegrityError
 
@@ -19,7 +20,9 @@ from db import (db_session, InvalidPasswordLength, Journalist, Reply, Source,
 import db
 import journalist
 import journalist_app.utils
+import store
 import utils
+import worker
 
 # Smugly seed the RNG for deterministic testing
 random.seed('¯\_(ツ)_/¯')
@@ -114,6 +117,19 @@ class TestJournalistApp(TestCase):
 
         self.assertNotIn("You cannot send an empty reply.", resp.data)
 
+    def test_reply_to_source_without_key(self):
+        source, _ = utils.db_helper.init_source_without_keypair()
+        self._login_user()
+
+        resp = self.client.post(url_for('main.reply'),
+                                data={'filesystem_id': source.filesystem_id,
+                                      'message': '_'},
+                                follow_redirects=True)
+
+        self.assert200(resp)
+        self.assertIn("You cannot reply to this source until", resp.data)
+        self.assertEqual(db.Reply.query.count(), 0)
+
     def test_unauthorized_access_redirects_to_login(self):
         resp = self.client.get(url_for('main.index'))
         self.assertRedirects(resp, url_for('main.login'))
@@ -234,6 +250,15 @@ class TestJournalistApp(TestCase):
     def _login_user(self):
         self._ctx.g.user = self.user
 
+    @patch('db.Journalist._scrypt_hash',
+           side_effect=crypto_util.ScryptBusyException)
+    def test_login_when_scrypt_pool_is_saturated(self, mock_scrypt_hash):
+        resp = self.client.post(url_for('main.login'),
+                                data=dict(username=self.user.username,
+                                          password=self.user_pw,
+                                          token='mocked'))
+        self.assertEqual(resp.status_code, 503)
+
     def test_admin_logout_redirects_to_index(self):
         self._login_admin()
         resp = self.client.get(url_for('main.logout'))
@@ -697,6 +722,73 @@ class TestJournalistApp(TestCase):
             resp = self.client.post(admin_url)
             self.assertStatus(resp, 302)
 
+    def test_download_single_submission_updates_unread_count(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        self._login_user()
+
+        for _ in range(2):
+            self.client.get(url_for('col.download_single_submission',
+                                    filesystem_id=source.filesystem_id,
+                                    fn=submissions[0].filename))
+
+        db_session.refresh(source)
+        self.assertTrue(submissions[0].downloaded)
+        self.assertEqual(source.unread_count, 1)
+
+    def test_bulk_delete_updates_source_counts(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        utils.db_helper.mark_downloaded(submissions[0])
+        self._login_user()
+
+        self.client.post(url_for('main.bulk'),
+                         data=dict(action='delete',
+                                   filesystem_id=source.filesystem_id,
+                                   doc_names_selected=[
+                                       submissions[0].filename,
+                                       submissions[1].filename]))
+
+        db_session.refresh(source)
+        self.assertEqual(source.message_count, 1)
+        self.assertEqual(source.unread_count, 1)
+        self.assertEqual(source.total_size, submissions[2].size)
+
+    @patch('worker.enqueue')
+    def test_bulk_delete_with_stale_submissions(self, enqueue):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        # Another request downloads a submission after ours loaded it
+        db.Submission.query.filter_by(id=submissions[0].id).update(
+            {db.Submission.downloaded: True}, synchronize_session=False)
+        db.Source.query.filter_by(id=source.id).update(
+            {db.Source.unread_count: 2}, synchronize_session=False)
+        self.assertFalse(submissions[0].downloaded)
+
+        with self.app.test_request_context('/'):
+            journalist_app.utils.bulk_delete(source.filesystem_id,
+                                             submissions[:2])
+
+        self.assertEqual(source.unread_count, 1)
+        self.assertEqual(source.message_count, 1)
+
+    @patch('worker.enqueue')
+    def test_bulk_delete_is_a_single_job(self, enqueue):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        filenames = [submission.filename for submission in submissions]
+        self._login_user()
+
+        self.client.post(url_for('main.bulk'),
+                         data=dict(action='delete',
+                                   filesystem_id=source.filesystem_id,
+                                   doc_names_selected=filenames))
+
+        enqueue.assert_called_once_with(
+            store.secure_delete, source.filesystem_id, filenames,
+            progress=worker.report_progress)
+        self.assertEqual(Submission.query.count(), 0)
+
     def test_user_authorization_for_gets(self):
         urls = [url_for('main.index'), url_for('col.col', filesystem_id='1'),
                 url_for('col.download_single_submission',
@@ -910,6 +1002,162 @@ class TestJournalistApp(TestCase):
                         filename
                     ))
 
+    def test_download_selected_submissions_with_x_sendfile(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        self._login_user()
+
+        with patch.dict(self.app.config, {'USE_X_SENDFILE': True}):
+            resp = self.client.post(
+                '/bulk', data=dict(action='download',
+                                   filesystem_id=source.filesystem_id,
+                                   doc_names_selected=[
+                                       submissions[0].filename]))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/zip')
+        archive_path = resp.headers['X-Sendfile']
+        self.assertTrue(archive_path.startswith(config.TEMP_DIR))
+        self.assertEqual(
+            zipfile.ZipFile(archive_path).namelist(),
+            [os.path.join(source.journalist_filename,
+                          "%s_%s" % (submissions[0].filename.split('-')[0],
+                                     source.last_updated.date()),
+                          submissions[0].filename)])
+
+    def test_download_selected_submissions_and_replies(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        reply = utils.db_helper.reply(self.user, source, 1)[0]
+        # Replies and submissions have ids of their own
+        self.assertEqual(reply.id, submissions[0].id)
+        self._login_user()
+
+        with patch.dict(self.app.config, {'USE_X_SENDFILE': True}):
+            resp = self.client.post(
+                '/bulk', data=dict(action='download',
+                                   filesystem_id=source.filesystem_id,
+                                   doc_names_selected=[
+                                       submissions[1].filename,
+                                       reply.filename]))
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            [os.path.basename(name) for name in
+             zipfile.ZipFile(resp.headers['X-Sendfile']).namelist()],
+            [submissions[1].filename, reply.filename])
+        db_session.expire_all()
+        self.assertFalse(db.Submission.query.get(submissions[0].id)
+                         .downloaded)
+        self.assertTrue(db.Submission.query.get(submissions[1].id)
+                        .downloaded)
+        self.assertEqual(db.Source.query.get(source.id).unread_count, 1)
+
+    def test_download_marks_submissions_downloaded_once_sent(self):
+        source, _ = utils.db_helper.init_source()
+        submission_ids = [submission.id for submission
+                          in utils.db_helper.submit(source, 2)]
+        self._login_user()
+
+        resp = self.client.post(url_for('col.process'),
+                                data=dict(action='download-unread',
+                                          cols_selected=[
+                                              source.filesystem_id]),
+                                buffered=False)
+        self.assertEqual(resp.status_code, 200)
+        iterator = iter(resp.response)
+        next(iterator)
+        self.assertFalse(any(db.Submission.query.get(id).downloaded
+                             for id in submission_ids))
+
+        list(iterator)
+        resp.close()
+        db_session.expire_all()
+        self.assertTrue(all(db.Submission.query.get(id).downloaded
+                            for id in submission_ids))
+        self.assertEqual(db.Source.query.get(source.id).unread_count, 0)
+
+    def test_download_selected_submissions_in_worker(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        self._login_user()
+
+        with patch.object(config, 'ASYNC_BULK_DOWNLOADS', True,
+                          create=True):
+            resp = self.client.post(
+                '/bulk', data=dict(action='download',
+                                   filesystem_id=source.filesystem_id,
+                                   doc_names_selected=[
+                                       submissions[0].filename]))
+
+        self.assertEqual(resp.status_code, 302)
+        job_id = resp.location.rstrip('/').split('/')[-1]
+        # Not until the archive is sent
+        self.assertFalse(submissions[0].downloaded)
+
+        def assert_finished():
+            resp = self.client.get(url_for('col.bulk_download_status',
+                                           job_id=job_id))
+            self.assertEqual(resp.json['status'], 'finished')
+            self.assertEqual((resp.json['done'], resp.json['total']),
+                             (1, 1))
+        utils.async.wait_for_assertion(assert_finished)
+
+        resp = self.client.get(url_for('col.bulk_download', job_id=job_id))
+        self.assertIn(url_for('col.bulk_download_archive', job_id=job_id),
+                      resp.data)
+
+        resp = self.client.get(url_for('col.bulk_download_archive',
+                                       job_id=job_id))
+        self.assertEqual(resp.content_type, 'application/zip')
+        db_session.expire_all()
+        self.assertTrue(db.Submission.query.get(submissions[0].id).downloaded)
+        self.assertFalse(db.Submission.query.get(submissions[1].id).downloaded)
+        self.assertEqual(
+            zipfile.ZipFile(StringIO(resp.data)).namelist(),
+            [os.path.join(source.journalist_filename,
+                          "%s_%s" % (submissions[0].filename.split('-')[0],
+                                     source.last_updated.date()),
+                          submissions[0].filename)])
+
+        # Other journalists can't follow or download the job
+        self._login_admin()
+        for endpoint in ('col.bulk_download', 'col.bulk_download_status',
+                         'col.bulk_download_archive'):
+            resp = self.client.get(url_for(endpoint, job_id=job_id))
+            self.assert404(resp)
+
+    def test_bulk_download_archive_marks_submissions_downloaded(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+        job = Mock(id='00000000-0000-0000-0000-000000000000',
+                   is_finished=True,
+                   meta={'filename': 'all.zip',
+                         'submission_ids': [submissions[0].id,
+                                            submissions[1].id]})
+        store.write_bulk_archive([], store.bulk_archive_path(job.id))
+        # Deleted after the archive was built
+        db_session.delete(submissions[1])
+        db_session.commit()
+        self._login_user()
+
+        with patch('journalist_app.col.get_bulk_download_job',
+                   return_value=job):
+            resp = self.client.get(url_for('col.bulk_download_archive',
+                                           job_id=job.id))
+
+        self.assertEqual(resp.content_type, 'application/zip')
+        db_session.expire_all()
+        self.assertTrue(db.Submission.query.get(submissions[0].id).downloaded)
+        self.assertFalse(db.Submission.query.get(submissions[2].id).downloaded)
+        self.assertEqual(db.Source.query.get(source.id).unread_count, 1)
+
+    def test_bulk_download_unknown_job(self):
+        self._login_user()
+        resp = self.client.get(url_for('col.bulk_download',
+                                       job_id='not-a-job'))
+        self.assert404(resp)
+
     def _bulk_download_setup(self):
         """Create a couple sources, make some submissions on their behalf,
         mark some of them as downloaded, and then perform *action* on all
@@ -991,6 +1239,56 @@ class TestJournalistApp(TestCase):
                         submission.filename
                     ))
 
+    def test_download_unread_marks_submissions_of_all_sources(self):
+        self._bulk_download_setup()
+        self._login_user()
+
+        # The submissions are marked as downloaded once the whole archive
+        # has been sent
+        self.client.post(url_for('col.process'),
+                         data=dict(action='download-unread',
+                                   cols_selected=[self.source0.filesystem_id,
+                                                  self.source1.filesystem_id]),
+                         buffered=True)
+
+        for source in (self.source0, self.source1):
+            db_session.refresh(source)
+            self.assertEqual(source.unread_count, 0)
+        for submission in self.submissions0 + self.submissions1:
+            self.assertTrue(submission.downloaded)
+
+    def test_get_submissions_eagerly_loads_sources(self):
+        self._bulk_download_setup()
+        filesystem_ids = [self.source0.filesystem_id,
+                          self.source1.filesystem_id]
+        expected = set(s.filename for s in
+                       self.not_downloaded0.union(self.not_downloaded1))
+        db_session.expunge_all()
+
+        submissions = journalist_app.utils.get_submissions(filesystem_ids,
+                                                           unread_only=True)
+
+        self.assertEqual(set(s.filename for s in submissions), expected)
+        for submission in submissions:
+            self.assertNotIn('source', inspect(submission).unloaded)
+
+    def test_mark_downloaded_with_stale_submissions(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        # Another request marks a submission as downloaded after ours
+        # loaded it
+        db.Submission.query.filter_by(id=submissions[0].id).update(
+            {db.Submission.downloaded: True}, synchronize_session=False)
+        db.Source.query.filter_by(id=source.id).update(
+            {db.Source.unread_count: 1}, synchronize_session=False)
+        self.assertFalse(submissions[0].downloaded)
+
+        journalist_app.utils.mark_downloaded(submissions)
+
+        self.assertEqual(source.unread_count, 0)
+        self.assertTrue(all(submission.downloaded
+                            for submission in submissions))
+
     def test_download_all_selected_sources(self):
         self._bulk_download_setup()
         self._login_user()
@@ -999,7 +1297,8 @@ class TestJournalistApp(TestCase):
         self.resp = self.client.post(
             url_for('col.process'),
             data=dict(action='download-all',
-                      cols_selected=[self.source1.filesystem_id]))
+                      cols_selected=[self.source1.filesystem_id]),
+            buffered=True)
 
         resp = self.client.post(
             url_for('col.process'),
@@ -1064,6 +1363,140 @@ class TestJournalistApp(TestCase):
         # Assert source is not starred
         self.assertFalse(source.star.starred)
 
+    def test_get_sources_by_star(self):
+        source_0, _ = utils.db_helper.init_source()
+        source_1, _ = utils.db_helper.init_source()
+        pending_source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source_0, 3)
+        utils.db_helper.submit(source_1, 1)
+        utils.db_helper.mark_downloaded(submissions[0])
+        source_0.pending = source_1.pending = False
+        journalist_app.utils.make_star_true(source_1.filesystem_id)
+        db_session.commit()
+
+        starred, unstarred, next_page = \
+            journalist_app.utils.get_sources_by_star()
+
+        self.assertEqual(starred, [source_1])
+        self.assertEqual(unstarred, [source_0])
+        self.assertIsNone(next_page)
+        self.assertEqual(source_0.unread_count, 2)
+        self.assertEqual(source_1.unread_count, 1)
+
+    def _init_sources_for_index(self, num_sources):
+        sources = []
+        for _ in range(num_sources):
+            source, _ = utils.db_helper.init_source_without_keypair()
+            utils.db_helper.submit(source, 1)
+            source.pending = False
+            sources.append(source)
+        db_session.commit()
+        # Most recently updated first, like the index
+        return sorted(sources, key=lambda s: (s.last_updated, s.id),
+                      reverse=True)
+
+    def test_get_sources_by_star_paginates(self):
+        sources = self._init_sources_for_index(5)
+
+        _, page_0, next_page = journalist_app.utils.get_sources_by_star(
+            limit=2)
+        self.assertEqual(page_0, sources[:2])
+        _, page_1, next_page = journalist_app.utils.get_sources_by_star(
+            after=next_page, limit=2)
+        self.assertEqual(page_1, sources[2:4])
+        _, page_2, next_page = journalist_app.utils.get_sources_by_star(
+            after=next_page, limit=2)
+        self.assertEqual(page_2, sources[4:])
+        self.assertIsNone(next_page)
+
+    def test_get_sources_by_star_filters(self):
+        sources = self._init_sources_for_index(3)
+        sources[0].flagged = True
+        utils.db_helper.mark_downloaded(*sources[1].submissions)
+        journalist_app.utils.make_star_true(sources[2].filesystem_id)
+        db_session.commit()
+        get_sources_by_star = journalist_app.utils.get_sources_by_star
+
+        self.assertEqual(get_sources_by_star({'flagged': True})[1],
+                         [sources[0]])
+        self.assertEqual(get_sources_by_star({'unread': True})[1],
+                         [sources[0]])
+        self.assertEqual(get_sources_by_star({'starred': True})[0],
+                         [sources[2]])
+        designation = sources[1].journalist_designation
+        self.assertIn(sources[1], get_sources_by_star(
+            {'designation': designation})[1])
+        self.assertEqual(get_sources_by_star({'designation': '%'}),
+                         ([], [], None))
+
+    def test_index_paginates(self):
+        sources = self._init_sources_for_index(3)
+        self._login_user()
+
+        with patch.object(config, 'SOURCES_PER_PAGE', 2, create=True):
+            resp = self.client.get(url_for('main.index'))
+            self.assertIn(sources[0].journalist_designation, resp.data)
+            self.assertNotIn(sources[2].journalist_designation, resp.data)
+            next_page = journalist_app.utils.format_cursor(
+                (sources[1].last_updated, sources[1].id))
+            self.assertIn(escape(url_for('main.index', after=next_page)),
+                          resp.data)
+
+            resp = self.client.get(url_for('main.index', after=next_page))
+            self.assertIn(sources[2].journalist_designation, resp.data)
+            self.assertNotIn(sources[0].journalist_designation, resp.data)
+
+    def test_index_invalid_cursor(self):
+        self._login_user()
+        resp = self.client.get(url_for('main.index', after='invalid'))
+        self.assert400(resp)
+
+    def test_process_all_matching_filter(self):
+        sources = self._init_sources_for_index(3)
+        sources[0].flagged = sources[1].flagged = True
+        db_session.commit()
+        self._login_user()
+
+        resp = self.client.post(url_for('col.process'),
+                                data=dict(action='star',
+                                          select_all_matching='1',
+                                          flagged='1'))
+
+        self.assertRedirects(resp, url_for('main.index'))
+        self.assertTrue(sources[0].star.starred)
+        self.assertTrue(sources[1].star.starred)
+        self.assertIsNone(sources[2].star)
+
+    def test_process_delete_all_matching_asks_for_confirmation(self):
+        sources = self._init_sources_for_index(3)
+        self._login_user()
+
+        with patch('journalist_app.utils.delete_collection') as delete:
+            resp = self.client.post(url_for('col.process'),
+                                    data=dict(action='delete',
+                                              select_all_matching='1'))
+            self.assert200(resp)
+            self.assert_template_used('delete_collections.html')
+            self.assertEqual(self.get_context_variable('count'), 3)
+            delete.assert_not_called()
+
+            # A count that no longer matches asks again
+            resp = self.client.post(url_for('col.process'),
+                                    data=dict(action='delete',
+                                              select_all_matching='1',
+                                              confirm_count='2'))
+            self.assert200(resp)
+            delete.assert_not_called()
+
+            resp = self.client.post(url_for('col.process'),
+                                    data=dict(action='delete',
+                                              select_all_matching='1',
+                                              confirm_count='3'))
+            self.assertRedirects(resp, url_for('main.index'))
+            self.assertEqual(
+                sorted(call[0][0] for call in delete.call_args_list),
+                sorted(source.filesystem_id for source in sources))
+
     def test_journalist_session_expiration(self):
         try:
             old_expiration = config.SESSION_EXPIRATION_MINUTES
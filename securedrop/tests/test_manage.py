@@ -16,6 +16,7 @@ import subprocess
 import sys
 import time
 import unittest
+import store
 import version
 import utils
 
@@ -151,6 +152,55 @@ class TestManagementCommand(unittest.TestCase):
         with self.assertRaises(NoResultFound):
             Journalist.query.filter_by(username=user_should_be_gone).one()
 
+    def test_backfill_fingerprints(self):
+        source, _ = utils.db_helper.init_source()
+        fingerprint = source.fingerprint
+        source.fingerprint = None
+        db_session.commit()
+
+        return_value = manage.backfill_fingerprints(args=None)
+
+        self.assertEqual(return_value, 0)
+        db_session.refresh(source)
+        self.assertEqual(source.fingerprint, fingerprint)
+
+    def test_recompute_counts(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        utils.db_helper.mark_downloaded(submissions[0])
+        source.message_count = source.unread_count = source.total_size = 0
+        db_session.commit()
+
+        return_value = manage.recompute_counts(args=None)
+
+        self.assertEqual(return_value, 0)
+        db_session.refresh(source)
+        self.assertEqual(source.message_count, 2)
+        self.assertEqual(source.document_count, 0)
+        self.assertEqual(source.unread_count, 1)
+        self.assertEqual(source.total_size,
+                         sum(s.size for s in submissions))
+
+    def test_shard_store(self):
+        source, _ = utils.db_helper.init_source()
+        submission = utils.db_helper.submit(source, 1)[0]
+        flat_path = store.path(source.filesystem_id, submission.filename)
+        args = argparse.Namespace(batch_size=1, pause=0)
+
+        self.assertEqual(manage.shard_store(args), 1)
+        self.assertTrue(os.path.exists(flat_path))
+
+        with mock.patch.object(config, 'STORE_LAYOUT', 'migrating',
+                               create=True):
+            self.assertEqual(manage.shard_store(args), 0)
+            self.assertFalse(os.path.exists(flat_path))
+            self.assertEqual(os.listdir(config.STORE_DIR),
+                             [store.shard(source.filesystem_id)[:2]])
+            sharded_path = store.path(source.filesystem_id,
+                                      submission.filename)
+
+        self.assertTrue(os.path.exists(sharded_path))
+
 
 class TestManage(object):
 
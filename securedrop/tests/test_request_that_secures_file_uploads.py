@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from cStringIO import StringIO
+from io import BytesIO
+import os
+import unittest
+
+from mock import patch
+from werkzeug.test import EnvironBuilder
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import request_that_secures_file_uploads
+from request_that_secures_file_uploads import (MemoryBudget,
+                                               RequestThatSecuresFileUploads)
+from secure_tempfile import SecureTemporaryFile
+
+
+def upload_request(*sizes):
+    data = dict(('fh{}'.format(i), (StringIO('x' * size), 'test.txt'))
+                for i, size in enumerate(sizes))
+    return RequestThatSecuresFileUploads(
+        EnvironBuilder(method='POST', data=data).get_environ())
+
+
+class TestRequestThatSecuresFileUploads(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = MemoryBudget(1024 * 1024)
+        patcher = patch.object(request_that_secures_file_uploads,
+                               'in_memory_budget', self.budget)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_small_uploads_are_kept_in_memory(self):
+        request = upload_request(1024, 1024)
+
+        for f in request.files.values():
+            self.assertIsInstance(f.stream, BytesIO)
+        # Reserved once for both files, until the request is closed
+        self.assertEqual(self.budget.used, request.content_length)
+        request.close()
+        self.assertEqual(self.budget.used, 0)
+
+    def test_large_uploads_are_encrypted_to_disk(self):
+        request = upload_request(
+            request_that_secures_file_uploads.IN_MEMORY_THRESHOLD)
+
+        self.assertIsInstance(request.files['fh0'].stream,
+                              SecureTemporaryFile)
+        self.assertEqual(self.budget.used, 0)
+        request.close()
+
+    def test_uploads_are_encrypted_to_disk_once_budget_is_used(self):
+        requests = [upload_request(300 * 1024) for _ in range(4)]
+
+        streams = [request.files['fh0'].stream for request in requests]
+        self.assertEqual([type(stream) for stream in streams],
+                         [BytesIO, BytesIO, BytesIO, SecureTemporaryFile])
+
+        requests[0].close()
+        request = upload_request(300 * 1024)
+        self.assertIsInstance(request.files['fh0'].stream, BytesIO)
+        for request in requests[1:] + [request]:
+            request.close()
+        self.assertEqual(self.budget.used, 0)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+os.environ['SECUREDROP_ENV'] = 'test'  # noqa
+import rm
+
+
+class TestSecureDelete(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def write(self, *names, **kwargs):
+        path = os.path.join(self.dir, *names)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(kwargs.get('data', 'secret'))
+        return path
+
+    def test_srm_overwrites_file_before_deleting_it(self):
+        path = self.write('doc.gz.gpg', data='secret' * 1000)
+        overwritten = []
+
+        def unlink(hidden):
+            with open(hidden) as f:
+                overwritten.append(f.read())
+            os.remove(hidden)
+
+        with mock.patch('os.fsync', wraps=os.fsync) as fsync, \
+                mock.patch('os.unlink', side_effect=unlink):
+            self.assertEqual(rm.srm(path, passes=2), 'success')
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(fsync.call_count, 2)
+        # Truncated once overwritten, and renamed
+        self.assertEqual(overwritten, [''])
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_srm_overwrites_file_like_srm_by_default(self):
+        path = self.write('doc.gz.gpg')
+        blocks = []
+
+        def write(fd, block, size):
+            blocks.append(block[:6].tobytes())
+
+        with mock.patch('rm._write', side_effect=write):
+            rm.srm(path)
+
+        self.assertEqual(rm.PASSES, 38)
+        self.assertEqual(len(blocks), 38)
+        self.assertEqual(blocks[0], '\xff' * 6)
+        self.assertEqual(blocks[8], '\x92\x49\x24' * 2)
+        self.assertEqual(blocks[32], '\xdb\x6d\xb6' * 2)
+        # Random data, which is different for each pass
+        random = blocks[1:6] + blocks[33:]
+        self.assertEqual(len(set(random)), 10)
+        self.assertFalse(os.path.exists(path))
+
+    def test_srm_overwrites_whole_blocks(self):
+        path = self.write('doc.gz.gpg')
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            size = rm._aligned_size(fd)
+        finally:
+            os.close(fd)
+        self.assertEqual(size, os.stat(path).st_blksize)
+
+        with mock.patch('rm._write', wraps=rm._write) as write:
+            rm.srm(path, passes=1)
+        self.assertEqual(write.call_args[0][2], size)
+
+    def test_srm_deletes_directory_tree(self):
+        collection = os.path.join(self.dir, 'collection')
+        for i in range(5):
+            self.write('collection', 'sub', '{}-doc.gz.gpg'.format(i))
+        self.write('collection', '1-reply.gpg')
+        outside = self.write('outside')
+        os.symlink(outside, os.path.join(collection, 'link'))
+        os.symlink(self.dir, os.path.join(collection, 'sub', 'dirlink'))
+        progress = mock.Mock()
+
+        with mock.patch('rm.BATCH_SIZE', 4):
+            rm.srm(collection, progress=progress)
+
+        self.assertFalse(os.path.exists(collection))
+        with open(outside) as f:
+            self.assertEqual(f.read(), 'secret')
+        self.assertEqual(progress.call_args_list,
+                         [mock.call(4, 6), mock.call(6, 6)])
+
+    def test_srm_missing_file(self):
+        with self.assertRaises(rm.SecureDeletionError):
+            rm.srm(os.path.join(self.dir, 'missing'))
+
+    def test_srm_many_deletes_what_it_can(self):
+        paths = [self.write('{}-doc.gz.gpg'.format(i)) for i in range(4)]
+        missing = os.path.join(self.dir, 'missing')
+        progress = mock.Mock()
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            if os.fstat(fd).st_ino == os.stat(paths[2]).st_ino:
+                raise OSError(5, 'Input/output error')
+            real_fsync(fd)
+
+        with mock.patch('os.fsync', side_effect=fsync), \
+                self.assertRaises(rm.SecureDeletionError) as ctx:
+            rm.srm_many(paths[:2] + [missing] + paths[2:], progress=progress)
+
+        self.assertEqual([path for path, _ in ctx.exception.failures],
+                         [missing, paths[2]])
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(paths[2])])
+        progress.assert_called_once_with(4, 4)
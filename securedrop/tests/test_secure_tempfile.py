@@ -3,6 +3,7 @@ import os
 import unittest
 
 from gnupg._util import _is_stream
+import mock
 
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 import config
@@ -96,3 +97,57 @@ class TestSecureTempfile(unittest.TestCase):
         invalid characters such as '/' and '\0' (null)."""
         self.assertNotIn('/', self.f.tmp_file_id)
         self.assertNotIn('\0', self.f.tmp_file_id)
+
+    def test_small_writes_are_encrypted_a_chunk_at_a_time(self):
+        f = secure_tempfile.SecureTemporaryFile(config.STORE_DIR,
+                                                chunk_size=1024)
+        f.write(self.msg)
+        self.assertEqual(os.path.getsize(f.filepath), 0)
+
+        while f.write_buffered:
+            f.write(self.msg)
+        self.assertGreaterEqual(os.path.getsize(f.filepath), 1024)
+
+        self.assertEqual(f.read(), self.msg * (os.path.getsize(f.filepath) /
+                                               len(self.msg)))
+
+    def test_small_reads_are_decrypted_a_chunk_at_a_time(self):
+        f = secure_tempfile.SecureTemporaryFile(config.STORE_DIR,
+                                                chunk_size=16 * 1024)
+        msg = os.urandom(64 * 1024)
+        f.write(msg)
+        data = ''
+
+        with mock.patch.object(f, 'decryptor',
+                               wraps=f.decryptor) as decryptor:
+            while True:
+                chunk = f.read(1024)
+                if not chunk:
+                    break
+                data += chunk
+
+        self.assertEqual(data, msg)
+        # 4 chunks, and the empty read at the end of the file
+        self.assertEqual(decryptor.decrypt.call_count, 5)
+
+    def test_openssl_and_pycrypto_ciphers_are_interchangeable(self):
+        key = os.urandom(32)
+        iv = secure_tempfile.random.getrandbits(128)
+        msg = os.urandom(1000)
+
+        encryptor = secure_tempfile.OpenSSLCTR(key, iv)
+        ciphertext = encryptor.encrypt(msg[:10]) + encryptor.encrypt(msg[10:])
+
+        self.assertEqual(
+            ciphertext, secure_tempfile.PyCryptoCTR(key, iv).encrypt(msg))
+        self.assertEqual(
+            secure_tempfile.PyCryptoCTR(key, iv).decrypt(ciphertext), msg)
+
+    def test_write_then_read_with_pycrypto(self):
+        with mock.patch('secure_tempfile.AES_CTR',
+                        secure_tempfile.PyCryptoCTR):
+            f = secure_tempfile.SecureTemporaryFile(config.STORE_DIR)
+        f.write(self.msg)
+
+        self.assertIsInstance(f.decryptor, secure_tempfile.PyCryptoCTR)
+        self.assertEqual(f.read(), self.msg)
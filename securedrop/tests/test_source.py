@@ -2,6 +2,8 @@
 from cStringIO import StringIO
 import gzip
 from mock import patch, ANY
+import os
+import Queue
 import re
 
 from bs4 import BeautifulSoup
@@ -11,8 +13,11 @@ from flask_testing import TestCase
 import crypto_util
 from db import db_session, Source
 import source
+import source_app.utils
+import store
 import version
 import utils
+import worker
 import json
 import config
 from utils.db_helper import new_codename
@@ -302,6 +307,25 @@ class TestSourceApp(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Thanks! We received your document', resp.data)
 
+    @patch('store.SecureTemporaryFile')
+    @patch('request_that_secures_file_uploads.SecureTemporaryFile')
+    def test_submit_file_is_encrypted_as_it_is_uploaded(
+            self, request_stf, store_stf):
+        with self.client as client:
+            new_codename(client, session)
+            resp = client.post('/submit', data=dict(
+                msg="",
+                fh=(StringIO('x' * 1024 * 1024), 'test.txt'),
+            ), follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            source = Source.query.filter_by(
+                filesystem_id=session['filesystem_id']).one()
+
+        self.assertFalse(request_stf.called)
+        self.assertFalse(store_stf.called)
+        self.assertEqual(os.listdir(store.path(source.filesystem_id)),
+                         [source.submissions[0].filename])
+
     def test_submit_both(self):
         with self.client as client:
             new_codename(client, session)
@@ -314,6 +338,23 @@ class TestSourceApp(TestCase):
             self.assertIn("Thanks! We received your message and document",
                           resp.data)
 
+    def test_submit_updates_source_counts(self):
+        with self.client as client:
+            new_codename(client, session)
+            client.post('/submit', data=dict(
+                msg="This is a test",
+                fh=(StringIO('This is a test'), 'test.txt'),
+            ), follow_redirects=True)
+            source = Source.query.filter(
+                Source.filesystem_id == crypto_util.hash_codename(
+                    session['codename'])).one()
+
+        self.assertEqual(source.message_count, 1)
+        self.assertEqual(source.document_count, 1)
+        self.assertEqual(source.unread_count, 2)
+        self.assertEqual(source.total_size,
+                         sum(s.size for s in source.submissions))
+
     @patch('source_app.main.async_genkey')
     @patch('source_app.main.get_entropy_estimate')
     def test_submit_message_with_low_entropy(self, get_entropy_estimate,
@@ -358,6 +399,37 @@ class TestSourceApp(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("All replies have been deleted", resp.data)
 
+    @patch('worker.enqueue')
+    def test_delete_all_replies_is_a_single_job(self, enqueue):
+        journalist, _ = utils.db_helper.init_journalist()
+        source, codename = utils.db_helper.init_source()
+        filenames = [reply.filename
+                     for reply in utils.db_helper.reply(journalist, source, 3)]
+        with self.client as c:
+            c.post('/login', data=dict(codename=codename))
+            resp = c.post('/delete-all', follow_redirects=True)
+            self.assertIn("All replies have been deleted", resp.data)
+
+        enqueue.assert_called_once_with(store.secure_delete,
+                                        source.filesystem_id, filenames,
+                                        progress=worker.report_progress)
+
+    @patch('worker.enqueue')
+    def test_delete_reply_is_queued(self, enqueue):
+        journalist, _ = utils.db_helper.init_journalist()
+        source, codename = utils.db_helper.init_source()
+        filename = utils.db_helper.reply(journalist, source, 1)[0].filename
+        with self.client as c:
+            c.post('/login', data=dict(codename=codename))
+            resp = c.post('/delete', data=dict(reply_filename=filename),
+                          follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Reply deleted", resp.data)
+
+        enqueue.assert_called_once_with(store.secure_delete,
+                                        source.filesystem_id, [filename],
+                                        progress=worker.report_progress)
+
     @patch('source.app.logger.error')
     def test_delete_all_replies_already_deleted(self, logger):
         journalist, _ = utils.db_helper.init_journalist()
@@ -432,11 +504,62 @@ class TestSourceApp(TestCase):
                              "Called hash_codename for codename w/ invalid "
                              "length")
 
+    def test_filesystem_id_is_kept_in_session(self):
+        with self.client as client:
+            codename = new_codename(client, session)
+            filesystem_id = crypto_util.hash_codename(codename)
+            self.assertEqual(session['filesystem_id'], filesystem_id)
+
+            with client.session_transaction() as sess:
+                sess.clear()
+            client.post('/login', data=dict(codename=codename))
+            self.assertEqual(session['filesystem_id'], filesystem_id)
+
+            with patch('crypto_util.hash_codename') as hash_codename:
+                resp = client.get('/lookup')
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(hash_codename.called)
+
+    def test_filesystem_id_missing_from_session(self):
+        with self.client as client:
+            codename = new_codename(client, session)
+            with client.session_transaction() as sess:
+                del sess['filesystem_id']
+
+            resp = client.get('/lookup')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(session['filesystem_id'],
+                             crypto_util.hash_codename(codename))
+
+    def test_lookup_decrypts_all_replies_at_once(self):
+        journalist, _ = utils.db_helper.init_journalist()
+        source, codename = utils.db_helper.init_source()
+        utils.db_helper.reply(journalist, source, 2)
+
+        with self.client as client:
+            client.post('/login', data=dict(codename=codename))
+            with patch('crypto_util.decrypt_many',
+                       return_value=['first reply', 'second reply']) as \
+                    decrypt_many:
+                resp = client.get('/lookup')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('first reply', resp.data)
+        self.assertIn('second reply', resp.data)
+        decrypt_many.assert_called_once_with(codename, [ANY, ANY],
+                                             source.fingerprint)
+
+    @patch('crypto_util.hash_codename',
+           side_effect=crypto_util.ScryptBusyException)
+    def test_login_when_scrypt_pool_is_saturated(self, hash_codename):
+        resp = self.client.post('/login', data=dict(codename='codename'))
+        self.assertEqual(resp.status_code, 503)
+
     @patch('source.app.logger.warning')
-    @patch('subprocess.call', return_value=1)
-    def test_failed_normalize_timestamps_logs_warning(self, call, logger):
-        """If a normalize timestamps event fails, the subprocess that calls
-        touch will fail and exit 1. When this happens, the submission should
+    @patch('os.utime', side_effect=OSError(1, 'Operation not permitted'))
+    def test_failed_normalize_timestamps_logs_warning(self, utime, logger):
+        """If a normalize timestamps event fails, updating the timestamps of
+        the submissions fails. When this happens, the submission should
         still occur, but a warning should be logged (this will trigger an
         OSSEC alert)."""
 
@@ -452,9 +575,28 @@ class TestSourceApp(TestCase):
 
             logger.assert_called_once_with(
                 "Couldn't normalize submission "
-                "timestamps (touch exited with 1)"
+                "timestamps ([Errno 1] Operation not permitted)"
             )
 
+    @patch('store.normalize_timestamps')
+    @patch('worker.enqueue')
+    def test_normalize_timestamps_of_many_submissions_in_worker(
+            self, enqueue, normalize_timestamps):
+        with patch.object(config, 'ASYNC_NORMALIZE_TIMESTAMPS_THRESHOLD', 2,
+                          create=True), self.client as client:
+            new_codename(client, session)
+            for i in range(3):
+                client.post('/submit', data=dict(
+                    msg="This is a test.",
+                    fh=(StringIO(''), ''),
+                ), follow_redirects=True)
+            filesystem_id = session['filesystem_id']
+
+        self.assertEqual(len(normalize_timestamps.call_args_list), 1)
+        enqueue.assert_called_once_with(normalize_timestamps, filesystem_id,
+                                        ANY)
+        self.assertEqual(len(enqueue.call_args[0][2]), 3)
+
     @patch('source.app.logger.error')
     def test_source_is_deleted_while_logged_in(self, logger):
         """If a source is deleted by a journalist when they are logged in,
@@ -479,6 +621,7 @@ class TestSourceApp(TestCase):
             self.assertIn('Submit documents for the first time', resp.data)
             self.assertNotIn('logged_in', session.keys())
             self.assertNotIn('codename', session.keys())
+            self.assertNotIn('filesystem_id', session.keys())
 
         logger.assert_called_once_with(
             "Found no Sources when one was expected: "
@@ -543,3 +686,105 @@ class TestSourceApp(TestCase):
                               resp.data)
         finally:
             self.app.config['WTF_CSRF_ENABLED'] = old_enabled
+
+    def test_keygen_pool_coalesces_pending_keypairs(self):
+        pool = source_app.utils.KeyGenerationPool(workers=0, max_queued=1)
+
+        self.assertTrue(pool.submit(self.app, 'fsid', 'codename'))
+        self.assertTrue(pool.submit(self.app, 'fsid', 'codename'))
+        self.assertEqual(pool.depth(), 1)
+
+        # The queue is full
+        self.assertFalse(pool.submit(self.app, 'other', 'codename'))
+        self.assertEqual(pool.depth(), 1)
+
+    @patch('source_app.utils.genkey')
+    def test_keygen_pool_generates_keypairs(self, genkey):
+        pool = source_app.utils.KeyGenerationPool(workers=1, max_queued=10)
+
+        pool.submit(self.app, 'fsid', 'codename')
+        pool.queue.join()
+
+        genkey.assert_called_once_with('fsid', 'codename')
+        self.assertEqual(pool.pending, set())
+        # The keypair can be requested again once it has been generated
+        self.assertTrue(pool.submit(self.app, 'fsid', 'codename'))
+        pool.queue.join()
+
+    @patch('worker.enqueue')
+    @patch('crypto_util.take_pooled_keypair', return_value='FINGERPRINT')
+    @patch('crypto_util.getkey', return_value=None)
+    @patch.object(crypto_util, 'KEYPOOL_LOW_WATER', 1)
+    @patch.object(crypto_util, 'KEYPOOL_SIZE', 3)
+    def test_genkey_refills_keypool_below_low_water(self, getkey,
+                                                    take_pooled_keypair,
+                                                    enqueue):
+        source, codename = utils.db_helper.init_source_without_keypair()
+
+        with patch('crypto_util.pooled_keypairs',
+                   return_value=['keypool-1', 'keypool-2']):
+            source_app.utils.genkey(source.filesystem_id, codename)
+        enqueue.assert_not_called()
+
+        with patch('crypto_util.pooled_keypairs', return_value=['keypool-1']):
+            source_app.utils.genkey(source.filesystem_id, codename)
+        enqueue.assert_called_once_with(crypto_util.fill_keypool)
+
+    def test_genkey_sets_fingerprint(self):
+        source, codename = utils.db_helper.init_source()
+        source.fingerprint = None
+        db_session.commit()
+
+        source_app.utils.genkey(source.filesystem_id, codename)
+
+        db_session.refresh(source)
+        self.assertEqual(source.fingerprint,
+                         crypto_util.getkey(source.filesystem_id))
+
+    @patch('source_app.utils.CodenamePool._start_thread')
+    def test_codename_pool_hands_out_codenames_once(self, start_thread):
+        pool = source_app.utils.CodenamePool(size=2)
+        pool.queues['en'] = Queue.Queue(maxsize=2)
+        with self.app.app_context():
+            pool._fill()
+        pooled = list(pool.queues['en'].queue)
+        self.assertEqual(len(set(pooled)), 2)
+
+        with patch('source_app.utils.generate_unique_codename',
+                   return_value=('codename', 'filesystem_id')) as generate:
+            codenames = [pool.get(self.app, 'en') for _ in range(3)]
+
+        # The pooled codenames are handed out first, and only once
+        self.assertEqual(codenames, pooled + [('codename', 'filesystem_id')])
+        self.assertEqual(generate.call_count, 1)
+        self.assertEqual(pool.pooled, set())
+        for codename, filesystem_id in pooled:
+            self.assertEqual(filesystem_id,
+                             crypto_util.hash_codename(codename))
+
+    def test_generate_serves_codenames_from_the_pool(self):
+        pool = source_app.utils.CodenamePool(size=1)
+
+        def assert_filled():
+            self.assertTrue(pool.queues['en'].full())
+
+        with patch('source_app.main.codename_pool', pool):
+            with self.client as client:
+                client.get('/generate')
+                # The first request starts the thread filling the pool
+                utils.async.wait_for_assertion(assert_filled)
+                pooled = pool.queues['en'].queue[0]
+
+                resp = client.get('/generate')
+                self.assertEqual((session['codename'],
+                                  session['filesystem_id']), pooled)
+                self.assertIn(escape(pooled[0]), resp.data)
+        pool.stop()
+
+    def test_codename_pool_disabled(self):
+        pool = source_app.utils.CodenamePool(size=0)
+        with patch('source_app.utils.generate_unique_codename',
+                   return_value=('codename', 'filesystem_id')):
+            self.assertEqual(pool.get(self.app, 'en'),
+                             ('codename', 'filesystem_id'))
+        self.assertIsNone(pool.thread)
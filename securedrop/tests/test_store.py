@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+from cStringIO import StringIO
+import gzip
 import os
 import shutil
+import struct
+import threading
 import unittest
 import zipfile
 
+import mock
+
 os.environ['SECUREDROP_ENV'] = 'test'  # noqa
 import config
+import crypto_util
 from db import db_session
 import store
 import utils
@@ -54,6 +61,58 @@ class TestStore(unittest.TestCase):
                                               filesystem_id, item_filename)
         self.assertEquals(generated_absolute_path, expected_absolute_path)
 
+    def test_trusted_path_matches_path(self):
+        filesystem_id = 'example'
+        item_filename = '1-quintuple_cant-msg.gpg'
+
+        self.assertEqual(store.trusted_path(filesystem_id),
+                         store.path(filesystem_id))
+        self.assertEqual(store.trusted_path(filesystem_id, item_filename),
+                         store.path(filesystem_id, item_filename))
+
+    def test_trusted_path_invalid_filesystem_id(self):
+        for filesystem_id in ('', '.', '..', '../etc', 'a/b'):
+            with self.assertRaisesRegexp(store.PathException,
+                                         'Invalid filesystem id'):
+                store.trusted_path(filesystem_id)
+
+    def test_trusted_path_invalid_filename(self):
+        for filename in ('..', '../1-foo-msg.gpg', 'NOTVALID.gpg'):
+            with self.assertRaisesRegexp(store.PathException,
+                                         'Invalid filename'):
+                store.trusted_path('example', filename)
+
+    def test_path_in_sharded_layout(self):
+        filesystem_id = 'example'
+        item_filename = '1-quintuple_cant-msg.gpg'
+        shard_path = os.path.join(config.STORE_DIR,
+                                  store.shard(filesystem_id))
+
+        with mock.patch.object(config, 'STORE_LAYOUT', 'sharded',
+                               create=True):
+            self.assertEqual(store.path(filesystem_id), shard_path)
+            self.assertEqual(store.trusted_path(filesystem_id, item_filename),
+                             os.path.join(shard_path, item_filename))
+        self.assertEqual(len(store.shard(filesystem_id).split(os.sep)), 3)
+
+    def test_path_while_migrating_to_sharded_layout(self):
+        filesystem_id = 'example'
+        flat_path = store.path(filesystem_id)
+        os.mkdir(flat_path)
+
+        with mock.patch.object(config, 'STORE_LAYOUT', 'migrating',
+                               create=True):
+            self.assertEqual(store.trusted_path(filesystem_id), flat_path)
+            store.move_to_shard(filesystem_id)
+            self.assertEqual(store.trusted_path(filesystem_id),
+                             os.path.join(config.STORE_DIR,
+                                          store.shard(filesystem_id)))
+            self.assertTrue(os.path.isdir(store.path(filesystem_id)))
+            # New sources go straight to the sharded layout
+            self.assertEqual(store.path('new'),
+                             os.path.join(config.STORE_DIR,
+                                          store.shard('new')))
+
     def test_verify_path_not_absolute(self):
         with self.assertRaises(store.PathException):
             store.verify(os.path.join(config.STORE_DIR, '..', 'etc', 'passwd'))
@@ -106,6 +165,29 @@ class TestStore(unittest.TestCase):
 
         shutil.rmtree(source_directory)  # Clean up created files
 
+    def test_normalize_timestamps(self):
+        filesystem_id = 'example-filesystem-id'
+        filenames = ['1-foo-msg.gpg', '2-foo-doc.gz.gpg', '3-foo-msg.gpg']
+        os.makedirs(store.path(filesystem_id))
+        for i, filename in enumerate(filenames):
+            path = store.path(filesystem_id, filename)
+            open(path, 'w').close()
+            os.utime(path, (1000 * i, 1000 * i))
+
+        store.normalize_timestamps(filesystem_id, filenames)
+
+        for filename in filenames:
+            st = os.stat(store.path(filesystem_id, filename))
+            self.assertEqual((st.st_atime, st.st_mtime), (2000, 2000))
+
+    def test_normalize_timestamps_invalid_filename(self):
+        filesystem_id = 'example-filesystem-id'
+        os.makedirs(store.path(filesystem_id))
+        with self.assertRaisesRegexp(store.PathException,
+                                     'Invalid filename'):
+            store.normalize_timestamps(filesystem_id,
+                                       ['../1-foo-msg.gpg', '2-foo-msg.gpg'])
+
     def test_get_zip(self):
         source, _ = utils.db_helper.init_source()
         submissions = utils.db_helper.submit(source, 2)
@@ -122,6 +204,100 @@ class TestStore(unittest.TestCase):
             zipped_file_content = archive.read(archived_file)
             self.assertEquals(zipped_file_content, actual_file_content)
 
+    def test_bulk_archive_groups_submissions_by_source(self):
+        source_0, _ = utils.db_helper.init_source()
+        source_1, _ = utils.db_helper.init_source()
+        submissions_0 = utils.db_helper.submit(source_0, 2)
+        submissions_1 = utils.db_helper.submit(source_1, 2)
+        # Interleave the submissions of both sources
+        submissions = [submissions_0[0], submissions_1[0],
+                       submissions_0[1], submissions_1[1]]
+
+        with mock.patch('store.trusted_path',
+                        wraps=store.trusted_path) as trusted_path:
+            entries = store.bulk_archive_entries(submissions, 'all')
+
+        self.assertEqual(trusted_path.call_count, len(submissions))
+        for source, source_submissions in ((source_0, submissions_0),
+                                           (source_1, submissions_1)):
+            for submission in source_submissions:
+                self.assertIn((
+                    store.path(source.filesystem_id, submission.filename),
+                    os.path.join('all', source.journalist_designation,
+                                 '%s_%s' % (submission.filename.split('-')[0],
+                                            source.last_updated.date()),
+                                 submission.filename)), entries)
+        # Entries of the same source are next to each other
+        designations = [arcname.split(os.sep)[1] for path, arcname in entries]
+        self.assertEqual(designations, sorted(designations,
+                                              key=designations.index))
+
+    def test_stream_bulk_archive(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 3)
+
+        streamed = ''.join(store.stream_bulk_archive(submissions, 'all'))
+        archive = zipfile.ZipFile(StringIO(streamed))
+        expected = zipfile.ZipFile(store.get_bulk_archive(submissions, 'all'))
+
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), expected.namelist())
+        for name in expected.namelist():
+            self.assertEqual(archive.read(name), expected.read(name))
+            self.assertEqual(archive.getinfo(name).compress_type,
+                             zipfile.ZIP_STORED)
+
+    def test_stream_bulk_archive_zip64(self):
+        """Lower the ZIP64 limit so archives use the ZIP64 records without
+        actually being larger than 2GB."""
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+
+        entries = store.bulk_archive_entries(submissions)
+
+        with mock.patch('zipfile.ZIP64_LIMIT', 64), \
+                mock.patch('zipfile.ZIP_FILECOUNT_LIMIT', 1):
+            streamed = ''.join(store.stream_bulk_archive(submissions))
+            # Read back with the lowered limits too, so zipfile has to rely
+            # on the ZIP64 records to find the sizes and offsets
+            archive = zipfile.ZipFile(StringIO(streamed))
+            self.assertIsNone(archive.testzip())
+            self.assertEqual(archive.namelist(),
+                             [arcname for path, arcname in entries])
+            for path, arcname in entries:
+                info = archive.getinfo(arcname)
+                self.assertEqual(info.file_size, os.path.getsize(path))
+                with open(path, 'rb') as f:
+                    self.assertEqual(archive.read(arcname), f.read())
+
+        self.assertIn(zipfile.stringEndArchive64, streamed)
+        self.assertIn(zipfile.stringEndArchive64Locator, streamed)
+        # The sizes in the central directory are in ZIP64 extra fields
+        for info in archive.infolist():
+            self.assertEqual(info.extra[:2], struct.pack('<H', 1))
+
+    def test_write_bulk_archive(self):
+        source, _ = utils.db_helper.init_source()
+        submissions = utils.db_helper.submit(source, 2)
+        entries = store.bulk_archive_entries(submissions, 'all')
+        archive_path = store.bulk_archive_path(
+            '0cb5b9d4-b6e3-4a5c-b6b0-3f6c1d8a6a4e')
+        progress = mock.Mock()
+
+        store.write_bulk_archive(entries, archive_path, progress=progress)
+
+        archive = zipfile.ZipFile(archive_path)
+        self.assertEqual(archive.namelist(),
+                         [arcname for path, arcname in entries])
+        self.assertEqual(progress.call_args_list,
+                         [mock.call(1, 2), mock.call(2, 2)])
+        self.assertEqual(os.listdir(config.TEMP_DIR),
+                         [os.path.basename(archive_path)])
+
+    def test_bulk_archive_path_with_invalid_job_id(self):
+        with self.assertRaises(store.PathException):
+            store.bulk_archive_path('../store')
+
     def test_rename_valid_submission(self):
         source, _ = utils.db_helper.init_source()
         old_journalist_filename = source.journalist_filename
@@ -143,3 +319,82 @@ class TestStore(unittest.TestCase):
         # None of the above files exist, so we expect the attempt to rename
         # the submission to fail and the original filename to be returned.
         self.assertEquals(original_filename, returned_filename)
+
+    def test_save_encrypted_upload(self):
+        source, _ = utils.db_helper.init_source()
+        upload = store.EncryptedUpload(source.filesystem_id, '../../x.txt')
+        upload.write('This is a test')
+        upload.seek(0)
+
+        filename = store.save_file_submission(source.filesystem_id, 1,
+                                              source.journalist_filename,
+                                              'x.txt', upload)
+        upload.close()
+
+        self.assertEqual(os.listdir(store.path(source.filesystem_id)),
+                         [filename])
+        ciphertext = open(store.path(source.filesystem_id, filename)).read()
+        plaintext = crypto_util.gpg.decrypt(ciphertext).data
+        with gzip.GzipFile(mode='rb', fileobj=StringIO(plaintext)) as gzf:
+            self.assertEqual(gzf.read(), 'This is a test')
+        # The original filename is kept in the gzip header
+        self.assertIn('x.txt\0', plaintext)
+
+    def test_directory_moved_to_shard_during_upload(self):
+        # Created before the migration started
+        source, _ = utils.db_helper.init_source()
+        patcher = mock.patch.object(config, 'STORE_LAYOUT', 'migrating',
+                                    create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        flat_path = os.path.join(config.STORE_DIR, source.filesystem_id)
+        self.assertEqual(store.path(source.filesystem_id), flat_path)
+        upload = store.EncryptedUpload(source.filesystem_id, 'x.txt')
+        upload.write('This is a test')
+
+        move = threading.Thread(target=store.move_to_shard,
+                                args=(source.filesystem_id,))
+        move.start()
+        move.join(0.5)
+        # Not until the upload is saved
+        self.assertTrue(move.is_alive())
+        self.assertTrue(os.path.isdir(flat_path))
+
+        filename = store.save_file_submission(source.filesystem_id, 1,
+                                              source.journalist_filename,
+                                              'x.txt', upload)
+        upload.close()
+        move.join()
+
+        shard_path = os.path.join(config.STORE_DIR,
+                                  store.shard(source.filesystem_id))
+        self.assertFalse(os.path.exists(flat_path))
+        self.assertEqual(os.listdir(shard_path), [filename])
+        ciphertext = open(store.path(source.filesystem_id, filename)).read()
+        plaintext = crypto_util.gpg.decrypt(ciphertext).data
+        with gzip.GzipFile(mode='rb', fileobj=StringIO(plaintext)) as gzf:
+            self.assertEqual(gzf.read(), 'This is a test')
+
+    @mock.patch.object(config, 'STORE_LAYOUT', 'migrating', create=True)
+    def test_secure_delete_after_directory_moved(self):
+        filesystem_id = 'example'
+        source_directory, _ = self.create_file_in_source_dir(filesystem_id,
+                                                             '1-reply.gpg')
+        open(os.path.join(source_directory, '2-reply.gpg'), 'w').close()
+        # Moved after the deletion was queued, before the worker runs it
+        store.move_to_shard(filesystem_id)
+
+        store.secure_delete(filesystem_id, ['1-reply.gpg'])
+        self.assertEqual(os.listdir(store.path(filesystem_id)),
+                         ['2-reply.gpg'])
+        store.secure_delete(filesystem_id)
+        self.assertFalse(os.path.exists(store.path(filesystem_id)))
+
+    def test_encrypted_upload_removed_unless_saved(self):
+        source, _ = utils.db_helper.init_source()
+        upload = store.EncryptedUpload(source.filesystem_id, 'x.txt')
+        upload.write('This is a test')
+
+        upload.close()
+
+        self.assertEqual(os.listdir(store.path(source.filesystem_id)), [])
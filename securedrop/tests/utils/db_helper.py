@@ -85,7 +85,9 @@ def mark_downloaded(*submissions):
                                       should be marked as downloaded.
     """
     for submission in submissions:
-        submission.downloaded = True
+        if not submission.downloaded:
+            submission.downloaded = True
+            submission.source.adjust_counts(sign=-1, unread_count=1)
     db.db_session.commit()
 
 
@@ -107,7 +109,7 @@ def init_source_without_keypair():
     db.db_session.add(source)
     db.db_session.commit()
     # Create the directory to store their submissions and replies
-    os.mkdir(store.path(source.filesystem_id))
+    os.makedirs(store.path(source.filesystem_id))
 
     return source, codename
 
@@ -122,7 +124,9 @@ def init_source():
     initialized. The second, their codename string.
     """
     source, codename = init_source_without_keypair()
-    crypto_util.genkeypair(source.filesystem_id, codename)
+    genkey_obj = crypto_util.genkeypair(source.filesystem_id, codename)
+    source.fingerprint = genkey_obj.fingerprint
+    db.db_session.commit()
 
     return source, codename
 
@@ -152,6 +156,7 @@ def submit(source, num_submissions):
         submissions.append(submission)
         db.db_session.add(submission)
 
+    source.adjust_counts(**db.Source.submission_counts(submissions))
     db.db_session.commit()
     return submissions
 
@@ -1,14 +1,34 @@
 import os
 
 from redis import Redis
-from rq import Queue
+from rq import Queue, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
 
 queue_name = 'test' if os.environ.get(
     'SECUREDROP_ENV') == 'test' else 'default'
 
-# `srm` can take a long time on large files, so allow it run for up to an hour
+# `rm.srm` can take a long time on large files, so allow it run for up to an
+# hour
 q = Queue(name=queue_name, connection=Redis(), default_timeout=3600)
 
 
 def enqueue(*args, **kwargs):
     return q.enqueue(*args, **kwargs)
+
+
+def fetch_job(job_id):
+    """Return the job *job_id*, or None if there is no such job (anymore)."""
+    try:
+        return Job.fetch(job_id, connection=q.connection)
+    except NoSuchJobError:
+        return None
+
+
+def report_progress(done, total):
+    """Record the progress of the job being run, if any, in its metadata so
+    it can be polled by the web applications."""
+    job = get_current_job()
+    if job is not None:
+        job.meta['progress'] = (done, total)
+        job.save_meta()